@@ -0,0 +1,104 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import zlib
+
+# Bump when parse_file output changes so cached records get rebuilt
+VERSION = 1
+
+
+def _digest(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+
+class ExtractionCache:
+    # Per-file extraction records in sqlite keyed by absolute path. An entry
+    # is used while its file keeps size and mtime, or keeps its content hash
+    # after just being touched. Entries of deleted files go with
+    # evict_missing(). Any number of processes can share one cache file.
+    def __init__(self, fname='extraction_cache.sqlite'):
+        self._db = sqlite3.connect(fname, timeout=60, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                sha1 BLOB,
+                records BLOB
+            )
+        ''')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != VERSION:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.execute('DELETE FROM files')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (VERSION,))
+            self._db.execute('COMMIT')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def get(self, fname):
+        path = os.path.abspath(fname)
+        row = self._db.execute(
+            'SELECT size, mtime_ns, sha1, records FROM files WHERE path = ?', (path,)
+        ).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, sha1, records = row
+        st = os.stat(path)
+        if st.st_size != size:
+            return None
+        if st.st_mtime_ns != mtime_ns:
+            if _digest(path) != sha1:
+                return None
+            self._db.execute(
+                'UPDATE files SET mtime_ns = ? WHERE path = ?', (st.st_mtime_ns, path)
+            )
+        return pickle.loads(zlib.decompress(records))
+
+    @staticmethod
+    def stamp(fname):
+        # Taken before parsing, so a file changing meanwhile fails the next
+        # lookup instead of keeping records older than its stamp
+        path = os.path.abspath(fname)
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime_ns, _digest(path)
+
+    def put_many(self, entries):
+        # `entries` are (stamp, records), written in one transaction
+        rows = [
+            stamp + (zlib.compress(pickle.dumps(records, pickle.HIGHEST_PROTOCOL)),)
+            for stamp, records in entries
+        ]
+        if not rows:
+            return
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def evict_missing(self):
+        paths = [p for p, in self._db.execute('SELECT path FROM files')]
+        missing = [(p,) for p in paths if not os.path.isfile(p)]
+        if missing:
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany('DELETE FROM files WHERE path = ?', missing)
+            self._db.execute('COMMIT')
+        return len(missing)
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
@@ -1,11 +1,44 @@
 from collections import defaultdict
 from dataclasses import dataclass
-from itertools import chain
+from itertools import chain, islice, repeat
 from typing import Iterable, Tuple, Union
 
 from lxml.html import HtmlElement, parse
 
 
+def _cell_text(e: HtmlElement):
+    # Cells with more than 7 text nodes are layout, not values, so at most 8
+    # are read
+    tt = [t.strip(' :\n\r') for t in islice(e.itertext(), 8)]
+    if len(tt) > 7 or not tt:
+        return ''
+    return ''.join(sorted(tt, key=len, reverse=True))
+
+
+def _colspan(e: HtmlElement):
+    try:
+        return max(int(e.attrib.get('colspan', 1)), 1)
+    except ValueError:
+        return 1
+
+
+class Table:
+    # Rows of a <table> with the text of every cell extracted once. `grid`
+    # repeats each cell by its colspan so columns line up across rows.
+    def __init__(self, e: HtmlElement, path: str = '/'):
+        self.element = e
+        self.path = path
+        self.rows = []
+        self.grid = []
+        for tr in e.findall('tr'):
+            cells = [c for c in tr if c.tag in ('td', 'th')]
+            texts = tuple(map(_cell_text, cells))
+            self.rows.append(texts)
+            self.grid.append(tuple(chain.from_iterable(
+                repeat(t, _colspan(c)) for c, t in zip(cells, texts)
+            )))
+
+
 class Proposer:
     search_pattern: str = ''
 
@@ -16,84 +49,39 @@ class Proposer:
 class TableProposer(Proposer):
     search_pattern: str = '//table'
 
-    @staticmethod
-    def _td_text(e: HtmlElement):
-        tt = sorted(
-            (t.strip(' :\n\r') for t in e.xpath(".//text()")),
-            key=lambda t: len(t),
-            reverse=True
-        )
-        if len(tt) > 7 or not tt:
-            return ''
-        return ''.join(tt)
-
-    @classmethod
-    def _match_rows(cls, rowh, rowv):
-        h = list(reversed(rowh))
-        v = list(reversed(rowv))
-        hn = 0
-        vn = 0
-        hh = None
-        vv = None
-
-        while True:
-            if not hn:
-                if not h:
-                    break
-                hh = h.pop()
-                hn = int(hh.attrib.get('colspan', 1))
-            if not vn:
-                if not v:
-                    break
-                vv = v.pop()
-                vn = int(hh.attrib.get('colspan', 1))
-            hn -= 1
-            vn -= 1
-            th = cls._td_text(hh)
-            tv = cls._td_text(vv)
-            if th and tv:
-                yield th, tv
+    def find_proposals(self, e: HtmlElement) -> Iterable[Tuple[str, str]]:
+        return self.table_proposals(Table(e))
 
-    @staticmethod
-    def _tr_cells(tr: HtmlElement):
-        return list(tr.xpath('./td | ./th'))
+    def table_proposals(self, table: Table) -> Iterable[Tuple[str, str]]:
+        return ()
 
     @staticmethod
-    def _table_trs(table: HtmlElement):
-        # tbody = table.find('tbody')
-        # if tbody is not None:
-        #     print('aaaaaaaaaa')
-        #     table = tbody
-        return tuple(tuple(table.findall('tr')))
+    def _match_rows(rowh, rowv):
+        for th, tv in zip(rowh, rowv):
+            if th and tv:
+                yield th, tv
 
 
 class TableVerticalProposer(TableProposer):
-    def find_proposals(self, e: HtmlElement) -> Iterable[Tuple[str, str]]:
-        last_row = []
-        for tr in self._table_trs(e):
-            current_row = self._tr_cells(tr)
+    def table_proposals(self, table: Table) -> Iterable[Tuple[str, str]]:
+        last_row = ()
+        for current_row in table.grid:
             yield from self._match_rows(last_row, current_row)
             last_row = current_row
 
 
 class TableHorizontalProposer(TableProposer):
-    def find_proposals(self, e: HtmlElement) -> Iterable[Tuple[str, str]]:
-        for tr in self._table_trs(e):
-            current_row = self._tr_cells(tr)
-            if current_row:
-                last_td = current_row[0]
-                for td in current_row[1:]:
-                    yield self._td_text(last_td), self._td_text(td)
-                    last_td = td
+    def table_proposals(self, table: Table) -> Iterable[Tuple[str, str]]:
+        for current_row in table.rows:
+            for i in range(1, len(current_row)):
+                yield current_row[i - 1], current_row[i]
 
 
 class TableVerticalHeaderProposer(TableProposer):
-    def find_proposals(self, e: HtmlElement) -> Iterable[Tuple[str, str]]:
-        trs = self._table_trs(e)
-        if trs:
-            header_row = self._tr_cells(trs[0])
-            for i, tr in enumerate(trs[1:]):
-                current_row = self._tr_cells(tr)
+    def table_proposals(self, table: Table) -> Iterable[Tuple[str, str]]:
+        if table.grid:
+            header_row = table.grid[0]
+            for i, current_row in enumerate(table.grid[1:]):
                 for k, v in self._match_rows(header_row, current_row):
                     yield f'{k}:{str(i).zfill(3)}', v
 
@@ -132,13 +120,33 @@ def find_table_proposals(proposals):
         yield k, tuple(col)
 
 
-def parse_file(fname) -> Iterable[PropertyProposal]:
+def find_tables(tree, paths=None) -> Tuple[Table, ...]:
+    tables = []
+    for e in tree.getroot().iter('table'):
+        current_path = tree.getpath(e)
+        if paths is None or current_path in paths:
+            tables.append(Table(e, current_path))
+    return tuple(tables)
+
+
+def parse_file(fname, paths=None) -> Iterable[PropertyProposal]:
+    # `paths` limits the proposals to elements at those paths
     tree = parse(fname)
     r = tree.getroot()
+    # Tables are walked once and shared by all table proposers
+    tables = find_tables(tree, paths)
     for proposer in PROPOSERS:
-        for e in r.xpath(proposer.search_pattern):
-            current_path = tree.getpath(e)
-            proposals = tuple(proposer.find_proposals(e))
+        if isinstance(proposer, TableProposer) and proposer.search_pattern == '//table':
+            found = ((t.path, proposer.table_proposals(t)) for t in tables)
+        else:
+            found = (
+                (tree.getpath(e), proposer.find_proposals(e))
+                for e in r.xpath(proposer.search_pattern)
+            )
+        for current_path, proposals in found:
+            if paths is not None and current_path not in paths:
+                continue
+            proposals = tuple(proposals)
 
             for k, v in chain(
                     find_table_proposals(proposals), proposals
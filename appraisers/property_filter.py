@@ -1,11 +1,55 @@
-from collections import defaultdict
-from itertools import chain
+import json
+import os
+import pickle
+import random
+import re
+from collections import defaultdict, deque
+from concurrent.futures.process import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache
+from itertools import chain, islice, repeat
 from operator import itemgetter
-from typing import Iterable
+from tempfile import TemporaryDirectory
+from typing import Iterable, List
+
+from appraisers.extraction_cache import ExtractionCache
+from appraisers.page import PROPOSERS, PropertyProposal, parse_file
+
+
+# Accept exactly what int() / float() accept on a str, without raising.
+# \s minus the \x1c-\x1f separators, which int() and float() do not strip.
+_WS = r'[^\S\x1c-\x1f]*'
+_DIGITS = r'\d(?:_?\d)*'
+_INT_RE = re.compile(_WS + r'[+-]?' + _DIGITS + _WS)
+_FLOAT_RE = re.compile(
+    _WS + r'[+-]?(?:'
+    + rf'(?:{_DIGITS}(?:\.(?:{_DIGITS})?)?|\.{_DIGITS})(?:[eE][+-]?{_DIGITS})?'
+    + r'|(?i:inf(?:inity)?|nan))' + _WS
+)
+# int() refuses longer decimal strings (sys.get_int_max_str_digits)
+_INT_MAX_LEN = 4300
+
+
+def _converts(fn, v):
+    try:
+        fn(v)
+        return True
+    except Exception:
+        return False
+
+
+def _is_int(v):
+    if not isinstance(v, str) or _INT_RE.fullmatch(v) is None:
+        return False
+    return len(v) <= _INT_MAX_LEN or _converts(int, v)
+
+
+def _is_float(v):
+    return isinstance(v, str) and _FLOAT_RE.fullmatch(v) is not None
 
-from lxml.html import parse
 
-from appraisers.page import PropertyProposal, find_table_proposals, parse_file
+def _is_money(v):
+    return isinstance(v, str) and v.startswith('$') and _is_float(v.strip(' $').replace(',', ''))
 
 
 def _number_rate(s: str):
@@ -28,6 +72,9 @@ class ValueConverter:
             # print(self.__class__, v)
             return 0.
 
+    def validate_many(self, vs: Iterable[str]) -> List[float]:
+        return [self.validate(v) for v in vs]
+
 
 class AddressConverter(ValueConverter):
     weight = 1.05
@@ -45,6 +92,12 @@ class IntConverter(ValueConverter):
     def convert(self, v: str):
         return int(v)
 
+    def validate(self, v: str) -> float:
+        return float(_is_int(v))
+
+    def validate_many(self, vs: Iterable[str]) -> List[float]:
+        return [float(_is_int(v)) for v in vs]
+
 
 class FloatConverter(ValueConverter):
     weight = 1.01
@@ -52,6 +105,12 @@ class FloatConverter(ValueConverter):
     def convert(self, v: str):
         return float(v)
 
+    def validate(self, v: str) -> float:
+        return float(_is_float(v))
+
+    def validate_many(self, vs: Iterable[str]) -> List[float]:
+        return [float(_is_float(v)) for v in vs]
+
 
 class MoneyConverter(FloatConverter):
     weight = 1.1
@@ -62,6 +121,12 @@ class MoneyConverter(FloatConverter):
         v = v.strip(' $').replace(',', '')
         return super().convert(v)
 
+    def validate(self, v: str) -> float:
+        return float(_is_money(v))
+
+    def validate_many(self, vs: Iterable[str]) -> List[float]:
+        return [float(_is_money(v)) for v in vs]
+
 
 class ColumnConverter:
     def __init__(self, cell_converter: ValueConverter):
@@ -69,14 +134,22 @@ class ColumnConverter:
         self.weight = cell_converter.weight * 1.2
 
     def validate(self, vs: Iterable[str]):
-        vs = tuple(vs)
-        if not vs:
-            return 0.
+        return self.validate_many((vs,))[0]
 
-        s = 0.
-        for v in vs:
-            s += self.cell_converter.validate(v)
-        return s / len(vs)
+    def validate_many(self, columns: Iterable[Iterable[str]]) -> List[float]:
+        # All cells of all columns are validated in one batch
+        columns = [tuple(vs) for vs in columns]
+        cells = iter(self.cell_converter.validate_many(chain.from_iterable(columns)))
+        r = []
+        for vs in columns:
+            if not vs:
+                r.append(0.)
+                continue
+            s = 0.
+            for v in islice(cells, len(vs)):
+                s += v
+            r.append(s / len(vs))
+        return r
 
     def convert(self, vs: Iterable[str]):
         vs = tuple(vs)
@@ -103,29 +176,55 @@ TABLE_CONVERTERS = (
 )
 
 
+_CONVERTERS = CONVERTERS + TABLE_CONVERTERS
+_CONVERTER_IDX = {id(c): i for i, c in enumerate(_CONVERTERS)}
+_PROPOSER_IDX = {id(p): i for i, p in enumerate(PROPOSERS)}
+
+
+@lru_cache(maxsize=1 << 16)
+def _is_key(key):
+    # The same keys come back on every page
+    return bool(key) and _number_rate(key) <= .5
+
+
+def _score_converters(key, value):
+    if not _is_key(key):
+        return None
+    if isinstance(value, str):
+        return CONVERTERS
+    return TABLE_CONVERTERS
+
+
+def _validated(values):
+    # One validate_many pass per converter over a batch of values, as
+    # iterators lining up with the values of their kind
+    strs = [v for v in values if isinstance(v, str)]
+    columns = [v for v in values if not isinstance(v, str)]
+    r = {id(c): iter(c.validate_many(strs)) for c in CONVERTERS}
+    r.update({id(c): iter(c.validate_many(columns)) for c in TABLE_CONVERTERS})
+    return r
+
+
+def _scored(batch):
+    # (tag, converter, weighted score) for (tag, key, value) items in the
+    # order validating them one by one gives
+    batch = [(tag, value, _score_converters(key, value)) for tag, key, value in batch]
+    batch = [b for b in batch if b[2] is not None]
+    validated = _validated([value for _, value, _ in batch])
+    for tag, value, cvts in batch:
+        for c in cvts:
+            yield tag, c, next(validated[id(c)]) * c.weight
+
+
 def score_props(props: Iterable[PropertyProposal]):
     scores = defaultdict(float)
-    for p in props:
-        if not p.key:
-            continue
-        if _number_rate(p.key) > .5:
-            continue
-
-        if isinstance(p.value, str):
-            cvts = CONVERTERS
-        else:
-            cvts = TABLE_CONVERTERS
-        for c in cvts:
-            key = (p.key, p.path, p.proposer, c)
-            scores[key] += c.validate(p.value) * c.weight
+    for batch in _chunks(((p, p.key, p.value) for p in props), 4096):
+        for p, c, s in _scored(batch):
+            scores[(p.key, p.path, p.proposer, c)] += s
     return sorted(scores.items(), key=lambda v: v[1], reverse=True)
 
 
-def filter_converters(files):
-    n = len(files)
-    scores = score_props(chain(*(
-        parse_file(f) for f in files
-    )))
+def _select_converters(scores, n):
     used = set()
     for k, s in scores:
         key, path, proposer, cvt = k
@@ -139,6 +238,21 @@ def filter_converters(files):
                 yield k
 
 
+def filter_converters(files, cache=None):
+    files = list(files)
+    if cache is None:
+        props = chain(*(parse_file(f) for f in files))
+    else:
+        props = (
+            PropertyProposal(key=k, value=v, proposer=PROPOSERS[pi], path=path)
+            for c in _chunks(files, 64)
+            for records in _file_records(c, cache)
+            for pi, path, k, v in records
+        )
+    scores = score_props(props)
+    yield from _select_converters(scores, len(files))
+
+
 def _format_converted(v):
     if v is None:
         return ''
@@ -149,36 +263,224 @@ def _format_converted(v):
     return str(v)
 
 
-def show_csv(files):
-    cvts = tuple(
-        filter_converters(files)
+def _converter_name(c):
+    if isinstance(c, ColumnConverter):
+        return f'Column{type(c.cell_converter).__name__}'
+    return type(c).__name__
+
+
+_CONVERTER_NAMES = {_converter_name(c): c for c in _CONVERTERS}
+_PROPOSER_NAMES = {type(p).__name__: p for p in PROPOSERS}
+
+
+class Schema:
+    # The (key, path, proposer, converter) columns chosen for an export,
+    # saved as JSON so pages can be extracted without scoring them again
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+        self.header_keys = tuple(sorted(
+            (path, key) for key, path, proposer, cvt in self.columns
+        ))
+        self.paths = frozenset(path for key, path, proposer, cvt in self.columns)
+
+    @property
+    def header(self):
+        return tuple(
+            map(itemgetter(1), self.header_keys)
+        )
+
+    def path_converters(self):
+        # {(path, proposer index): {key: converter index}}
+        path_cvts = defaultdict(dict)
+        for key, path, proposer, cvt in self.columns:
+            path_cvts[(path, _PROPOSER_IDX[id(proposer)])][key] = _CONVERTER_IDX[id(cvt)]
+        return dict(path_cvts)
+
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump([{
+                'key': key,
+                'path': path,
+                'proposer': type(proposer).__name__,
+                'converter': _converter_name(cvt),
+            } for key, path, proposer, cvt in self.columns], f, indent=1)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'r') as f:
+            return cls(
+                (c['key'], c['path'], _PROPOSER_NAMES[c['proposer']], _CONVERTER_NAMES[c['converter']])
+                for c in json.load(f)
+            )
+
+
+def _records(props: Iterable[PropertyProposal]):
+    # Compact (proposer, path, key, value) records, proposers and converters
+    # are referred to by index to keep them picklable
+    return [(_PROPOSER_IDX[id(p.proposer)], p.path, p.key, p.value) for p in props]
+
+
+def _score_records(records, scores):
+    for (key, path, pi), c, s in _scored(
+            ((key, path, pi), key, value) for pi, path, key, value in records
+    ):
+        scores[(key, path, pi, _CONVERTER_IDX[id(c)])] += s
+
+
+def _file_records(files, cache=None, paths=None):
+    # Records of each file, taken from the extraction cache file `cache` for
+    # unchanged files. Misses are parsed in full, whatever `paths` asks for,
+    # and written back together.
+    if cache is None:
+        return [_records(parse_file(f, paths)) for f in files]
+    out = []
+    parsed = []
+    with ExtractionCache(cache) as c:
+        for f in files:
+            records = c.get(f)
+            if records is None:
+                stamp = c.stamp(f)
+                records = _records(parse_file(f))
+                parsed.append((stamp, records))
+            out.append(records)
+        c.put_many(parsed)
+    return out
+
+
+def _evict_missing(cache):
+    if cache is not None:
+        with ExtractionCache(cache) as c:
+            c.evict_missing()
+
+
+def _parse_chunk(files, records_fname=None, cache=None):
+    # Parses each file once and scores its proposals, the records are kept
+    # in `records_fname` for the row pass
+    scores = defaultdict(float)
+    chunk_records = []
+    for records in _file_records(files, cache):
+        _score_records(records, scores)
+        if records_fname is not None:
+            chunk_records.append(records)
+    if records_fname is not None:
+        with open(records_fname, 'wb') as rf:
+            pickle.dump(chunk_records, rf, pickle.HIGHEST_PROTOCOL)
+    return scores
+
+
+def _reduce_scores(chunk_scores):
+    scores = defaultdict(float)
+    for part in chunk_scores:
+        for k, s in part.items():
+            scores[k] += s
+    return sorted(
+        (((key, path, PROPOSERS[pi], _CONVERTERS[ci]), s)
+         for (key, path, pi, ci), s in scores.items()),
+        key=lambda v: v[1], reverse=True
     )
 
-    path_cvts = defaultdict(dict)
-    for key, path, proposer, cvt in cvts:
-        path_cvts[(path, proposer)][key] = cvt
-    hdr = tuple(sorted(
-        (path, key) for key, path, proposer, cvt in cvts
+
+def _row(records, path_cvts, hdr):
+    vals = defaultdict(str)
+    tables = defaultdict(list)
+    for pi, path, k, v in records:
+        tables[(path, pi)].append((k, v))
+    for (path, pi), val_cvts in path_cvts.items():
+        for k, v in tables.get((path, pi), ()):
+            if k in val_cvts:
+                try:
+                    vals[(path, k)] = _format_converted(_CONVERTERS[val_cvts[k]].convert(v))
+                except ValueError:
+                    pass
+    return tuple((
+        vals[key] for key in hdr
     ))
-    yield tuple(
-        map(itemgetter(1), hdr)
-    )
-    for f in files:
-        vals = defaultdict(str)
-        tree = parse(f)
-        r = tree.getroot()
-        for (path, proposer), val_cvts in path_cvts.items():
-            ee = r.xpath(path)
-            if ee:
-                proposals = tuple(proposer.find_proposals(ee[0]))
-                for k, v in chain(
-                        find_table_proposals(proposals), proposals
-                ):
-                    if k in val_cvts:
-                        try:
-                            vals[(path, k)] = _format_converted(val_cvts[k].convert(v))
-                        except ValueError:
-                            pass
-        yield tuple((
-            vals[key] for key in hdr
+
+
+def _chunk_rows(records_fname, path_cvts, hdr):
+    with open(records_fname, 'rb') as rf:
+        chunk_records = pickle.load(rf)
+    return [_row(records, path_cvts, hdr) for records in chunk_records]
+
+
+def _extract_chunk(files, path_cvts, hdr, paths, cache=None):
+    return [_row(records, path_cvts, hdr) for records in _file_records(files, cache, paths)]
+
+
+def _chunks(files, chunk):
+    files = iter(files)
+    return iter(lambda: list(islice(files, chunk)), [])
+
+
+def _map_bounded(pool: ProcessPoolExecutor, fn, chunks, window, *args):
+    # Like pool.map, but keeps at most `window` chunks submitted
+    pending = deque()
+    for c in chunks:
+        pending.append(pool.submit(fn, c, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def infer_schema(files, sample=1000, seed=0, workers=None, chunk=64, cache=None):
+    # Scores a reproducible random sample of `files`, memory grows with the
+    # sample instead of the corpus. `cache` is an ExtractionCache file name
+    # shared by all workers, here and in extract_csv / show_csv.
+    files = list(files)
+    if len(files) > sample:
+        picked = sorted(random.Random(seed).sample(range(len(files)), sample))
+        files = [files[i] for i in picked]
+    chunks = list(_chunks(files, chunk))
+    caches = repeat(None, len(chunks)), repeat(cache)
+    if workers == 0:
+        chunk_scores = map(_parse_chunk, chunks, *caches)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            chunk_scores = list(pool.map(_parse_chunk, chunks, *caches))
+    return Schema(_select_converters(_reduce_scores(chunk_scores), len(files)))
+
+
+def extract_csv(files, schema: Schema, workers=None, chunk=64, cache=None):
+    # Streams rows for any number of pages with a saved schema: the header
+    # comes first, pages are parsed chunk by chunk in `workers` processes
+    # (0 runs inline) and only the schema's tables are looked at, unless
+    # pages go through the extraction `cache`, which keeps them whole
+    args = schema.path_converters(), schema.header_keys, schema.paths, cache
+    _evict_missing(cache)
+    yield schema.header
+    if workers == 0:
+        for c in _chunks(files, chunk):
+            yield from _extract_chunk(c, *args)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        window = 2 * (workers or os.cpu_count())
+        for rows in _map_bounded(pool, _extract_chunk, _chunks(files, chunk), window, *args):
+            yield from rows
+
+
+def show_csv(files, workers=None, chunk=64, cache=None):
+    # Every file is parsed once, in `workers` processes (0 runs inline).
+    # Chunks of files are scored in parallel and their proposals spilled
+    # to a temporary directory, then re-read for the rows. With `cache`
+    # unchanged files are not parsed at all.
+    files = list(files)
+    chunks = list(_chunks(files, chunk))
+    _evict_missing(cache)
+    with TemporaryDirectory() as tmp, ExitStack() as stack:
+        if workers == 0:
+            map_chunks = map
+        else:
+            map_chunks = stack.enter_context(ProcessPoolExecutor(workers)).map
+        records_fnames = [os.path.join(tmp, f'{i}.pickle') for i in range(len(chunks))]
+
+        schema = Schema(_select_converters(
+            _reduce_scores(map_chunks(_parse_chunk, chunks, records_fnames, repeat(cache))),
+            len(files)
         ))
+        yield schema.header
+        for rows in map_chunks(
+                _chunk_rows, records_fnames, repeat(schema.path_converters()),
+                repeat(schema.header_keys)
+        ):
+            yield from rows
@@ -1,8 +1,12 @@
 import json
 from collections import defaultdict
-from itertools import product
+from functools import partial
 
-from scrape import RequestHandler
+from cost_matrix import CostMatrix
+from crawl import crawl_tree
+from http_cache import ResponseCache
+from retry import FetchError, RetryPolicy
+from scrape import RequestHandler, map_scrape
 from storage import JSONStorage
 
 
@@ -10,6 +14,15 @@ def api_url(action):
     return f'https://www.lmigroup.com/RiskCoachCalculatorsApi/api/{action}'
 
 
+def _is_json(status, body):
+    # Only parseable answers are cached, a broken one is fetched again
+    try:
+        json.loads(body)
+    except ValueError:
+        return False
+    return True
+
+
 def get_locations(req: RequestHandler, location_id, country_id):
     resp = req.get(api_url('Location'), {
         'parentId': location_id,
@@ -18,21 +31,16 @@ def get_locations(req: RequestHandler, location_id, country_id):
     return json.loads(resp)
 
 
-def scrape_locations(country_id):
-    req = RequestHandler()
+def scrape_locations(country_id, threads=8, cache: ResponseCache = None):
+    req = RequestHandler(cache=cache, cacheable=_is_json)
     with JSONStorage(f'lmigroup_{country_id}') as stor:
-        st = [0]
-        while st:
-            n = st.pop()
-            print(n)
-            key = f'loc_{n}'
-            if stor.has_item(key):
-                data = stor.read_item(key)
-            else:
-                data = get_locations(req, n, country_id)
-                stor.store_item(key, data)
-            for i in data:
-                st.append(i['id'])
+        crawl_tree(
+            stor, 'locations', [0],
+            fetch=lambda n: get_locations(req, n, country_id),
+            key=lambda n: f'loc_{n}',
+            children=lambda n, data: [i['id'] for i in data],
+            threads=threads
+        )
 
 
 def get_construction_types(req: RequestHandler, parent_id, is_primary, country_id):
@@ -44,61 +52,126 @@ def get_construction_types(req: RequestHandler, parent_id, is_primary, country_i
     return json.loads(resp)
 
 
-def scrape_construction_types(country_id):
-    req = RequestHandler()
+def _construction_key(node):
+    n, p = node
+    key = f'constr_{n}'
+    if p:
+        key += 'p'
+    return key
+
+
+def scrape_construction_types(country_id, threads=8, cache: ResponseCache = None):
+    req = RequestHandler(cache=cache, cacheable=_is_json)
     with JSONStorage(f'lmigroup_{country_id}') as stor:
-        st = [(0, True), (0, False)]
-        while st:
-            n, p = st.pop()
-            print(n, p)
-            key = f'constr_{n}'
-            if p:
-                key += 'p'
-            if stor.has_item(key):
-                data = stor.read_item(key)
-            else:
-                data = get_construction_types(req, n, p, country_id)
-                stor.store_item(key, data)
-            for i in data:
-                st.append((i['id'], p))
+        crawl_tree(
+            stor, 'construction_types', [(0, True), (0, False)],
+            fetch=lambda node: get_construction_types(req, node[0], node[1], country_id),
+            key=_construction_key,
+            children=lambda node, data: [(i['id'], node[1]) for i in data],
+            threads=threads
+        )
 
 
-def calculate_cost(req, location_id, construction_id):
-    data = {
+def _cost_payload(location_id, construction_ids):
+    return {
         "locationId": location_id,
         "calculators": [
             {"id": construction_id, "area": 1000}
+            for construction_id in construction_ids
         ]
     }
-    r = req.post(api_url('BuildingCostCalcualtor'), data)
+
+
+def calculate_cost(req, location_id, construction_id):
+    r = req.post(api_url('BuildingCostCalcualtor'), _cost_payload(location_id, [construction_id]))
     return json.loads(r)
 
 
-def scrape_costs(country_id):
+def _post_costs(req: RequestHandler, cell):
+    location, constructions = cell
+    return req.request('POST', api_url('BuildingCostCalcualtor'), data=_cost_payload(
+        location['id'], [c['id'] for c in constructions]
+    ))
+
+
+def _split_costs(data, constructions):
+    # One result per calculator when the API reports them separately,
+    # None when a batch came back as a single combined result
+    if len(constructions) == 1:
+        return [data]
+    results = data.get('calculators') if isinstance(data, dict) else data
+    if isinstance(results, list) and len(results) == len(constructions):
+        return results
+    return None
+
+
+def _plan_costs(stor: JSONStorage, locations, constructions, batch):
+    # `batch()` is asked before every cell so a run can fall back to single ids
+    for location in locations:
+        missing = [
+            c for c in constructions
+            if not stor.has_item(f'cost_{location["id"]}_{c["id"]}')
+        ]
+        i = 0
+        while i < len(missing):
+            n = batch()
+            yield location, missing[i:i + n]
+            i += n
+
+
+def scrape_costs(country_id, threads=16, batch=1):
+    # `batch` construction ids are sent in one request, raise it only for
+    # countries where the API returns per-calculator results
     req = RequestHandler()
-    with JSONStorage(f'lmigroup_{country_id}') as stor:
-        stor.clear_errors()
+    with JSONStorage(f'lmigroup_{country_id}') as stor, CostMatrix(stor.path) as costs:
+        if costs.empty:
+            _import_costs(stor, costs)
+        # Only err marks are dropped, checking the records of millions of
+        # cost_* cells would stall the start
+        stor.clear_errors(check_records=False)
         locations = []
         constructions = []
-        for i in stor.items():
-            if i.startswith('loc_'):
-                locations.extend(stor.read_item(i))
-            if i.startswith('constr_'):
-                constructions.extend(stor.read_item(i))
-        for location, construction in product(locations, constructions):
-            print(location['id'], construction['id'])
-            key = f'cost_{location["id"]}_{construction["id"]}'
-            if not stor.has_item(key):
-                data = calculate_cost(
-                    req, location['id'], construction['id']
-                )
-                data['location'] = location
-                data['construction'] = construction
-                if 'message' in data:
-                    print(data['message'])
-                    stor.mark_notfound(key, data['message'])
-                else:
-                    stor.store_item(key, data)
+        for i in stor.items('loc_'):
+            locations.extend(stor.read_item(i))
+        for i in stor.items('constr_'):
+            constructions.extend(stor.read_item(i))
+        single = False
+        cells = _plan_costs(
+            stor, locations, constructions, lambda: 1 if single else batch
+        )
+        while True:
+            unsplit = []
+            for (location, cell_constructions), body in map_scrape(
+                    partial(_post_costs, req), cells,
+                    threads=threads, ordered=False, retry=RetryPolicy()
+            ):
+                if isinstance(body, FetchError):
+                    print(location['id'], body)
+                    continue
+                results = _split_costs(json.loads(body), cell_constructions)
+                if results is None:
+                    # The API combined the batch: its cells are sent again one
+                    # id each and the rest of the run goes with single ids
+                    single = True
+                    unsplit.extend((location, [c]) for c in cell_constructions)
+                    continue
+                for construction, data in zip(cell_constructions, results):
+                    print(location['id'], construction['id'])
+                    key = f'cost_{location["id"]}_{construction["id"]}'
+                    data['location'] = location
+                    data['construction'] = construction
+                    if 'message' in data:
+                        print(data['message'])
+                        stor.mark_notfound(key, data['message'])
+                    else:
+                        stor.store_item(key, data)
+                        costs.set(
+                            location['id'], construction['id'],
+                            data['lowerCost'], data['upperCost']
+                        )
+            if not unsplit:
+                break
+            cells = unsplit
 
 
 def show_construction_types(country_id):
@@ -107,19 +180,36 @@ def show_construction_types(country_id):
         0: 'root'
     }
     with JSONStorage(f'lmigroup_{country_id}') as stor:
-        for i in stor.items():
-            if i.startswith('constr_'):
-                data = stor.read_item(i)
-                for v in data:
-                    if v:
-                        d.append((v['id'], v))
-                        ii[v['id']] = v['name']
+        for i in stor.items('constr_'):
+            data = stor.read_item(i)
+            for v in data:
+                if v:
+                    d.append((v['id'], v))
+                    ii[v['id']] = v['name']
     for i, v in sorted(d):
         print(i, v['name'])
         print('parent: ', ii[v['parentId']])
         print()
 
 
+def _import_costs(stor: JSONStorage, costs: CostMatrix):
+    # Stores scraped before the matrix existed get their cost_* records
+    # imported while it is still empty
+    for i in stor.items('cost_'):
+        if stor.is_correct(i):
+            cost_data = stor.read_item(i)
+            costs.set(
+                cost_data['location']['id'], cost_data['construction']['id'],
+                cost_data['lowerCost'], cost_data['upperCost']
+            )
+
+
+def build_cost_matrix(country_id):
+    # Re-imports every cost_* record into the matrix
+    with JSONStorage(f'lmigroup_{country_id}') as stor, CostMatrix(stor.path) as costs:
+        _import_costs(stor, costs)
+
+
 def create_csv(country_id):
     con_n = {}
     loc_n = {}
@@ -128,22 +218,19 @@ def create_csv(country_id):
 
     cost_array = defaultdict(lambda: defaultdict(list))
 
-    with JSONStorage(f'lmigroup_{country_id}') as stor:
-        stor.clear_errors()
-        for i in stor.items():
-            if i.startswith('loc_'):
-                for l in stor.read_item(i):
-                    loc_n[l['id']] = l['name'].strip()
-            if i.startswith('constr_'):
-                for c in stor.read_item(i):
-                    con_n[c['id']] = c['name'].strip()
-            if i.startswith('cost_'):
-                cost_data = stor.read_item(i)
-                occ_used.add(cost_data['construction']['id'])
-                loc_used.add(cost_data['location']['id'])
-                cost_array[cost_data['construction']['id']][cost_data['location']['id']] = [
-                    cost_data['lowerCost'], cost_data['upperCost']
-                ]
+    with JSONStorage(f'lmigroup_{country_id}') as stor, CostMatrix(stor.path) as costs:
+        if costs.empty:
+            _import_costs(stor, costs)
+        for i in stor.items('loc_'):
+            for l in stor.read_item(i):
+                loc_n[l['id']] = l['name'].strip()
+        for i in stor.items('constr_'):
+            for c in stor.read_item(i):
+                con_n[c['id']] = c['name'].strip()
+        for location_id, construction_id, lower, upper in costs.cells():
+            occ_used.add(construction_id)
+            loc_used.add(location_id)
+            cost_array[construction_id][location_id] = [lower, upper]
 
     occ_ids = sorted(occ_used)
     loc_ids = sorted(loc_used)
@@ -0,0 +1,339 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures.process import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlsplit
+
+# Direct connection, no tor proxy and no headers.txt needed
+HEADERS = {'User-Agent': 'benchmark'}
+PROXIES = {'http': None, 'https': None}
+
+
+class FakeApi(ThreadingHTTPServer):
+    # Local stand-in for the melissa zip4, us_parcels and LMI endpoints.
+    # Every response waits `latency` seconds, `error_rate` of them are a 503
+    # or a block page and JSON bodies are padded to about `payload` bytes.
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=.005, error_rate=0., payload=1024, seed=0, port=0):
+        super().__init__(('127.0.0.1', port), _FakeApiHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload = payload
+        self.random = random.Random(seed)
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def handle_error(self, request, client_address):
+        # clients dropping connections mid-response are part of the load
+        pass
+
+    def pad(self, record):
+        n = self.payload - len(json.dumps(record))
+        if n > 0:
+            record['pad'] = 'x' * n
+        return json.dumps(record).encode()
+
+
+class _FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body: bytes, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self):
+        if self.server.random.random() < .5:
+            self._send(503, b'Service Unavailable', 'text/plain')
+        else:
+            self._send(200, b'<html><body>Access denied</body></html>', 'text/html')
+
+    def _respond(self):
+        api = self.server
+        if api.latency:
+            sleep(api.latency)
+        if api.error_rate and api.random.random() < api.error_rate:
+            return self._fail()
+        url = urlsplit(self.path)
+        q = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith('/v2/lookups/zip4/'):
+            zip4 = q.get('zip4', '')
+            return self._send(200, api.pad({
+                'zip4': zip4,
+                'records': [{'address': f'{i} MAIN ST', 'zip': zip4[:5]} for i in range(5)],
+            }))
+        if url.path.startswith('/parcels/'):
+            parcel_id = url.path.rsplit('/', 1)[-1].split('.')[0]
+            return self._send(200, api.pad({
+                'id': parcel_id,
+                'owner': 'JOHN SMITH',
+                'value': 123456,
+            }))
+        if url.path.endswith('/api/Location') or url.path.endswith('/api/ConstructionType'):
+            parent_id = int(q.get('parentId', 0))
+            return self._send(200, json.dumps([
+                {'id': parent_id * 10 + i, 'name': f'node {parent_id * 10 + i}'}
+                for i in range(1, 4)
+            ]).encode())
+        if url.path.endswith('/api/BuildingCostCalcualtor'):
+            return self._send(200, api.pad({'lowerCost': 1000., 'upperCost': 2000.}))
+        self._send(404, b'{"message": "Not found"}')
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._respond()
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _endpoint(base, endpoint, n):
+    # URL template and items the way the scrape jobs call map_scrape_get
+    if endpoint == 'melissa':
+        template = f'{base}/v2/lookups/zip4/zip4/?zip4={{}}&tbl=mak&fmt=json'
+        return template, [f'{37000 + i // 10000:05d}-{i % 10000:04d}' for i in range(n)]
+    if endpoint == 'us_parcels':
+        return '{}', [f'{base}/parcels/{47035970102 + i}.json' for i in range(n)]
+    if endpoint == 'lmi':
+        template = f'{base}/RiskCoachCalculatorsApi/api/Location?parentId={{}}&countryId=9'
+        return template, [str(i) for i in range(n)]
+    raise ValueError(f'Unknown endpoint {endpoint}')
+
+
+def _is_block_page(body: bytes):
+    return not body.lstrip().startswith((b'{', b'['))
+
+
+def bench_scrape(base, endpoint, n, backend, threads):
+    from metrics import METRICS
+    from retry import FetchError, RetryPolicy
+    from scrape import map_scrape_get
+
+    url_template, items = _endpoint(base, endpoint, n)
+    failed = 0
+    METRICS.reset()
+    t = perf_counter()
+    for _, body in map_scrape_get(
+            url_template, items, threads=threads, backend=backend, ordered=False,
+            retry=RetryPolicy(backoff=.01, max_backoff=.1, retry_body=_is_block_page),
+            raw=True, headers=HEADERS, proxies=PROXIES
+    ):
+        failed += isinstance(body, FetchError)
+    elapsed = perf_counter() - t
+    latency = METRICS.snapshot()['histograms']['http.latency']
+    return {
+        'items': n,
+        'failed': failed,
+        'requests': latency['count'],
+        'elapsed': elapsed,
+        'items_per_s': n / elapsed,
+        'requests_per_s': latency['count'] / elapsed,
+        'p50': latency['p50'],
+        'p99': latency['p99'],
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+def bench_storage(d, n, payload, backend):
+    from storage import JSONStorage
+
+    record = {'id': 0, 'owner': 'JOHN SMITH', 'pad': 'x' * payload}
+    with JSONStorage(d, backend=backend) as stor:
+        t = perf_counter()
+        for i in range(n):
+            record['id'] = i
+            stor.store_item(str(i), record)
+        stor.flush()
+        store_elapsed = perf_counter() - t
+
+    with JSONStorage(d, backend=backend) as stor:
+        t = perf_counter()
+        missing = sum(1 for _ in stor.filter_items(map(str, range(2 * n))))
+        filter_elapsed = perf_counter() - t
+        t = perf_counter()
+        for i in range(n):
+            stor.read_item(str(i))
+        read_elapsed = perf_counter() - t
+    return {
+        'items': n,
+        'missing': missing,
+        'store_per_s': n / store_elapsed,
+        'filter_per_s': 2 * n / filter_elapsed,
+        'read_per_s': n / read_elapsed,
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+def _appraiser_page(rnd: random.Random, i):
+    years = ''.join(
+        f'<tr><td>{2020 - y}</td><td>${rnd.randint(10, 90) * 1000:,}</td>'
+        f'<td>${rnd.randint(100, 900) * 1000:,}</td></tr>'
+        for y in range(rnd.randint(3, 8))
+    )
+    return f'''<html><body><div id="main">
+<table>
+<tr><td>Parcel ID:</td><td>{47035970102 + i}</td></tr>
+<tr><td>Owner:</td><td>SMITH JOHN {i}</td></tr>
+<tr><td>Property Address:</td><td>{rnd.randint(1, 9999)} MAIN ST CROSSVILLE</td></tr>
+<tr><td>Year Built:</td><td>{rnd.randint(1900, 2020)}</td></tr>
+<tr><td>Acres:</td><td>{rnd.randint(1, 500) / 100}</td></tr>
+<tr><td>Appraised Value:</td><td>${rnd.randint(50, 900) * 1000:,}</td></tr>
+</table>
+<table><tr><th>Year</th><th>Land Value</th><th>Total Value</th></tr>{years}</table>
+</div></body></html>'''
+
+
+def write_pages(d, n, seed=0):
+    rnd = random.Random(seed)
+    os.makedirs(d, exist_ok=True)
+    files = []
+    for i in range(n):
+        fname = os.path.join(d, f'{i}.html')
+        with open(fname, 'w') as f:
+            f.write(_appraiser_page(rnd, i))
+        files.append(fname)
+    return files
+
+
+def bench_show_csv(d, n):
+    from appraisers.property_filter import show_csv
+
+    files = write_pages(d, n)
+    t = perf_counter()
+    rows = sum(1 for _ in show_csv(files))
+    elapsed = perf_counter() - t
+    return {
+        'files': n,
+        'rows': rows,
+        'files_per_s': n / elapsed,
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+def _isolated(fn, *args):
+    # Each benchmark gets a fresh interpreter so peak RSS is its own
+    with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def run(n=2000, files=200, threads=64, latency=.005, error_rate=0., payload=1024,
+        only=None):
+    report = {
+        'commit': _commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'config': {
+            'n': n, 'files': files, 'threads': threads,
+            'latency': latency, 'error_rate': error_rate, 'payload': payload,
+        },
+        'results': {},
+    }
+    results = report['results']
+
+    def selected(name):
+        return not only or any(name.startswith(o) for o in only)
+
+    api = FakeApi(latency, error_rate, payload).start()
+    tmp = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        for endpoint in ('melissa', 'us_parcels', 'lmi'):
+            for backend in ('threads', 'async'):
+                name = f'scrape.{endpoint}.{backend}'
+                if selected(name):
+                    results[name] = _isolated(bench_scrape, api.url, endpoint, n, backend, threads)
+        for backend in ('files', 'segments'):
+            name = f'storage.{backend}'
+            if selected(name):
+                results[name] = _isolated(
+                    bench_storage, os.path.join(tmp, backend), n, payload, backend
+                )
+        if selected('show_csv'):
+            results['show_csv'] = _isolated(bench_show_csv, os.path.join(tmp, 'pages'), files)
+    finally:
+        api.shutdown()
+        shutil.rmtree(tmp)
+    return report
+
+
+def compare(old, new):
+    # Ratio new / old of every numeric result both reports have
+    out = {}
+    for name, r in new['results'].items():
+        o = old['results'].get(name)
+        if o is None:
+            continue
+        out[name] = {
+            k: v / o[k] for k, v in r.items()
+            if isinstance(v, (int, float)) and isinstance(o.get(k), (int, float)) and o[k]
+        }
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scrape and storage benchmarks')
+    parser.add_argument('-n', type=int, default=2000, help='requests / records per benchmark')
+    parser.add_argument('--files', type=int, default=200, help='pages for show_csv')
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=.005, help='server latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--payload', type=int, default=1024, help='response / record bytes')
+    parser.add_argument('--only', nargs='*', help='benchmark name prefixes to run')
+    parser.add_argument('--compare', help='earlier report to compare against')
+    parser.add_argument('-o', '--out', help='write the report here instead of stdout')
+    args = parser.parse_args()
+
+    report = run(
+        args.n, args.files, args.threads, args.latency, args.error_rate, args.payload,
+        args.only
+    )
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            report['compare'] = compare(json.load(f), report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import json
+import os
+import zlib
+from os import path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+ZLIB_MAGIC = b'\x78'
+
+
+class RecordCodec:
+    # Per-record compression with optional shared dictionaries. Compressed
+    # records are recognized by their frame magic, plain JSON records are
+    # passed through, so stores can hold a mix of both.
+    def __init__(self, d, compression=None, level=None):
+        if compression not in (None, 'zlib', 'zstd'):
+            raise ValueError(f'Unknown compression {compression}')
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+        self._d = path.join(d, 'dicts')
+        self._compression = compression
+        self._level = level
+        self._dicts = {}
+        self._compressor = None
+        self._decompressors = {}
+
+    def _dict_path(self, kind, dict_id):
+        return path.join(self._d, f'{kind}_{dict_id}.dict')
+
+    def _load_dict(self, kind, dict_id):
+        key = kind, dict_id
+        if key not in self._dicts:
+            with open(self._dict_path(kind, dict_id), 'rb') as f:
+                self._dicts[key] = f.read()
+        return self._dicts[key]
+
+    def _current_dict_id(self):
+        try:
+            with open(path.join(self._d, 'current.json'), 'r') as f:
+                return json.load(f).get(self._compression)
+        except FileNotFoundError:
+            return None
+
+    def _get_compressor(self):
+        if self._compressor is None:
+            dict_id = self._current_dict_id()
+            zdict = self._load_dict(self._compression, dict_id) if dict_id is not None else None
+            if self._compression == 'zstd':
+                self._compressor = zstandard.ZstdCompressor(
+                    level=self._level or 3,
+                    dict_data=zstandard.ZstdCompressionDict(zdict) if zdict else None
+                )
+            else:
+                self._compressor = zdict or b''
+        return self._compressor
+
+    def encode(self, data: bytes) -> bytes:
+        if self._compression is None:
+            return data
+        c = self._get_compressor()
+        if self._compression == 'zstd':
+            return c.compress(data)
+        level = self._level or 6
+        z = zlib.compressobj(level, zdict=c) if c else zlib.compressobj(level)
+        return z.compress(data) + z.flush()
+
+    def decode(self, data: bytes) -> bytes:
+        if data[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise ValueError('zstd compressed record, the zstandard package is required')
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            d = self._decompressors.get(dict_id)
+            if d is None:
+                zdict = self._load_dict('zstd', dict_id) if dict_id else None
+                d = self._decompressors[dict_id] = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(zdict) if zdict else None
+                )
+            return d.decompress(data)
+        if data[:1] == ZLIB_MAGIC:
+            if data[1] & 0x20:
+                dict_id = int.from_bytes(data[2:6], 'big')
+                z = zlib.decompressobj(zdict=self._load_dict('zlib', dict_id))
+                return z.decompress(data) + z.flush()
+            return zlib.decompress(data)
+        return data
+
+    def train(self, samples, size=112640):
+        if self._compression is None:
+            return
+        samples = list(samples)
+        if self._compression == 'zstd':
+            zdict = zstandard.train_dictionary(size, samples)
+            dict_id = zdict.dict_id()
+            zdict = zdict.as_bytes()
+        else:
+            # zlib only looks back 32KB, the most common content goes last
+            zdict = b''.join(samples)[-32768:]
+            dict_id = zlib.adler32(zdict)
+
+        os.makedirs(self._d, exist_ok=True)
+        with open(self._dict_path(self._compression, dict_id), 'wb') as f:
+            f.write(zdict)
+        try:
+            with open(path.join(self._d, 'current.json'), 'r') as f:
+                current = json.load(f)
+        except FileNotFoundError:
+            current = {}
+        current[self._compression] = dict_id
+        with open(path.join(self._d, 'current.json'), 'w') as f:
+            json.dump(current, f)
+        self._dicts[self._compression, dict_id] = zdict
+        self._compressor = None
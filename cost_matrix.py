@@ -0,0 +1,191 @@
+import json
+import math
+import mmap
+import os
+import struct
+from os import path
+
+_NAN = struct.pack('<d', math.nan)
+
+# Kind of each stored bound, so values read back as the JSON gave them
+_MISSING = 0
+_NONE = 1
+_INT = 2
+_FLOAT = 3
+
+
+def _kind(v):
+    if v is None:
+        return _NONE
+    if isinstance(v, int):
+        return _INT
+    return _FLOAT
+
+
+def _value(kind, v):
+    if kind == _INT:
+        return int(v)
+    if kind == _FLOAT:
+        return v
+    return None
+
+
+class CostMatrix:
+    # Persistent location x construction x (lower, upper) grid of float64
+    # in `{d}/cost_matrix.bin`, with the kind of every value (missing, None,
+    # int or float) in a byte grid `{d}/cost_matrix.kinds` of the same
+    # shape. Id to index maps live in `{d}/cost_matrix.json`.
+    def __init__(self, d, con_capacity=256, loc_capacity=256):
+        self._fname = path.join(d, 'cost_matrix.bin')
+        self._kinds_fname = path.join(d, 'cost_matrix.kinds')
+        self._index_fname = path.join(d, 'cost_matrix.json')
+        self._con_capacity = con_capacity
+        self._loc_capacity = loc_capacity
+        self._locations = []
+        self._constructions = []
+
+    def __enter__(self):
+        if not path.isfile(self._kinds_fname):
+            # Matrices from before the kinds grid start over empty and get
+            # re-imported from the store
+            for fname in (self._fname, self._index_fname):
+                if path.isfile(fname):
+                    os.unlink(fname)
+        try:
+            with open(self._index_fname, 'r') as f:
+                index = json.load(f)
+            self._locations = index['locations']
+            self._constructions = index['constructions']
+            self._con_capacity = index['con_capacity']
+            self._loc_capacity = index['loc_capacity']
+        except FileNotFoundError:
+            self._write_index()
+        self._loc_idx = {v: i for i, v in enumerate(self._locations)}
+        self._con_idx = {v: i for i, v in enumerate(self._constructions)}
+        if not path.isfile(self._fname):
+            self._create(self._fname, _NAN, self._loc_capacity, self._con_capacity)
+            self._create(self._kinds_fname, bytes(1), self._loc_capacity, self._con_capacity)
+        self._open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._close()
+
+    def _write_index(self):
+        with open(self._index_fname + '.tmp', 'w') as f:
+            json.dump({
+                'locations': self._locations,
+                'constructions': self._constructions,
+                'con_capacity': self._con_capacity,
+                'loc_capacity': self._loc_capacity,
+            }, f)
+        os.replace(self._index_fname + '.tmp', self._index_fname)
+
+    @staticmethod
+    def _create(fname, fill, loc_capacity, con_capacity):
+        row = fill * (2 * con_capacity)
+        with open(fname, 'wb') as f:
+            for _ in range(loc_capacity):
+                f.write(row)
+
+    def _open(self):
+        self._f = open(self._fname, 'r+b')
+        self._mm = mmap.mmap(self._f.fileno(), 0)
+        self._view = memoryview(self._mm).cast('d')
+        self._kinds_f = open(self._kinds_fname, 'r+b')
+        self._kinds_mm = mmap.mmap(self._kinds_f.fileno(), 0)
+        self._kinds = memoryview(self._kinds_mm)
+
+    def _close(self):
+        self._view.release()
+        self._mm.close()
+        self._f.close()
+        self._kinds.release()
+        self._kinds_mm.close()
+        self._kinds_f.close()
+
+    def _grow_locations(self):
+        self._close()
+        for fname, fill in (self._fname, _NAN), (self._kinds_fname, bytes(1)):
+            with open(fname, 'ab') as f:
+                row = fill * (2 * self._con_capacity)
+                for _ in range(self._loc_capacity):
+                    f.write(row)
+        self._loc_capacity *= 2
+        self._open()
+
+    def _grow_constructions(self):
+        con_capacity = self._con_capacity * 2
+        row_len = 2 * self._con_capacity
+        for fname, view, fill in (
+                (self._fname, self._view, _NAN), (self._kinds_fname, self._kinds, bytes(1))
+        ):
+            with open(fname + '.tmp', 'wb') as f:
+                pad = fill * (2 * (con_capacity - self._con_capacity))
+                for i in range(self._loc_capacity):
+                    f.write(view[i * row_len:(i + 1) * row_len].tobytes() + pad)
+        self._close()
+        os.replace(self._fname + '.tmp', self._fname)
+        os.replace(self._kinds_fname + '.tmp', self._kinds_fname)
+        self._con_capacity = con_capacity
+        self._open()
+
+    def _location(self, location_id):
+        i = self._loc_idx.get(location_id)
+        if i is None:
+            i = self._loc_idx[location_id] = len(self._locations)
+            self._locations.append(location_id)
+            if i >= self._loc_capacity:
+                self._grow_locations()
+            self._write_index()
+        return i
+
+    def _construction(self, construction_id):
+        j = self._con_idx.get(construction_id)
+        if j is None:
+            j = self._con_idx[construction_id] = len(self._constructions)
+            self._constructions.append(construction_id)
+            if j >= self._con_capacity:
+                self._grow_constructions()
+            self._write_index()
+        return j
+
+    @property
+    def empty(self):
+        return not self._locations
+
+    def set(self, location_id, construction_id, lower, upper):
+        i = self._location(location_id)
+        j = self._construction(construction_id)
+        o = (i * self._con_capacity + j) * 2
+        self._view[o] = math.nan if lower is None else lower
+        self._view[o + 1] = math.nan if upper is None else upper
+        self._kinds[o] = _kind(lower)
+        self._kinds[o + 1] = _kind(upper)
+
+    def get(self, location_id, construction_id):
+        i = self._loc_idx.get(location_id)
+        j = self._con_idx.get(construction_id)
+        if i is None or j is None:
+            return None
+        o = (i * self._con_capacity + j) * 2
+        lower_kind, upper_kind = self._kinds[o], self._kinds[o + 1]
+        if lower_kind == _MISSING and upper_kind == _MISSING:
+            return None
+        return _value(lower_kind, self._view[o]), _value(upper_kind, self._view[o + 1])
+
+    def cells(self):
+        # Yields (location id, construction id, lower, upper) of every
+        # filled cell in one sequential pass over the grid
+        width = 2 * len(self._constructions)
+        for i, location_id in enumerate(self._locations):
+            base = i * self._con_capacity * 2
+            row = self._view[base:base + width].tolist()
+            kinds = self._kinds[base:base + width].tolist()
+            for j, construction_id in enumerate(self._constructions):
+                lower_kind, upper_kind = kinds[2 * j], kinds[2 * j + 1]
+                if lower_kind != _MISSING or upper_kind != _MISSING:
+                    yield (
+                        location_id, construction_id,
+                        _value(lower_kind, row[2 * j]), _value(upper_kind, row[2 * j + 1])
+                    )
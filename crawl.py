@@ -0,0 +1,101 @@
+import json
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from storage import JSONStorage
+
+
+class Frontier:
+    # Append-only log of discovered (+) and expanded (-) tree nodes, nodes
+    # are any JSON serializable values
+    def __init__(self, fname):
+        self._fname = fname
+        self._pending = {}
+
+    def __enter__(self):
+        self.fresh = not os.path.isfile(self._fname)
+        if not self.fresh:
+            with open(self._fname, 'r') as f:
+                for l in f:
+                    try:
+                        op, node = json.loads(l)
+                    except ValueError:
+                        continue
+                    k = json.dumps(node)
+                    if op == '+':
+                        self._pending[k] = node
+                    else:
+                        self._pending.pop(k, None)
+        self._f = open(self._fname, 'a')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._f.close()
+        # Only keep what is still pending, an empty log marks a finished crawl
+        with open(self._fname + '.tmp', 'w') as f:
+            for node in self._pending.values():
+                f.write(json.dumps(['+', node]) + '\n')
+        os.replace(self._fname + '.tmp', self._fname)
+
+    def pending(self):
+        return list(self._pending.values())
+
+    def add(self, nodes):
+        added = []
+        for node in nodes:
+            k = json.dumps(node)
+            if k not in self._pending:
+                self._pending[k] = node
+                added.append(node)
+        self._f.write(''.join(json.dumps(['+', node]) + '\n' for node in added))
+        self._f.flush()
+        return added
+
+    def done(self, node):
+        self._pending.pop(json.dumps(node), None)
+        self._f.write(json.dumps(['-', node]) + '\n')
+        self._f.flush()
+
+
+def crawl_tree(stor: JSONStorage, name, roots, fetch, key, children, threads=8):
+    # Expands a parent/child tree concurrently: `fetch(node)` downloads the
+    # data for a node, stored under `key(node)`, and `children(node, data)`
+    # lists the nodes below it. The frontier is persisted next to the store,
+    # so a resumed crawl continues where it stopped without re-reading
+    # finished subtrees.
+    with Frontier(f'{stor.path}/frontier_{name}.log') as frontier:
+        if frontier.fresh:
+            frontier.add(roots)
+        queue = deque(frontier.pending())
+        futures = {}
+
+        def expand(node, data):
+            queue.extend(frontier.add(children(node, data)))
+            frontier.done(node)
+
+        with ThreadPoolExecutor(threads) as pool:
+            while queue or futures:
+                while queue and len(futures) < threads * 2:
+                    node = queue.popleft()
+                    k = key(node)
+                    if stor.is_correct(k):
+                        # stored before an interrupted run marked it done
+                        expand(node, stor.read_item(k))
+                    else:
+                        futures[pool.submit(fetch, node)] = node
+                if not futures:
+                    continue
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for f in done:
+                    node = futures.pop(f)
+                    print(node)
+                    try:
+                        data = f.result()
+                    except Exception as e:
+                        # stays in the frontier for the next run
+                        print(node, e.__class__.__name__, e)
+                        continue
+                    stor.store_item(key(node), data)
+                    expand(node, data)
@@ -0,0 +1,134 @@
+import hashlib
+import json
+import sqlite3
+from threading import Lock
+from time import time
+
+CACHEABLE_STATUS = (200, 203, 300, 301, 404, 410)
+
+
+class CachedResponse:
+    def __init__(self, status, body: bytes, encoding, etag, last_modified, stored_at):
+        self.status = status
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def content(self, raw):
+        if raw:
+            return self.body
+        return self.body.decode(self.encoding or 'utf-8', 'replace')
+
+
+class ResponseCache:
+    # On-disk response cache keyed by method, url and request body. Entries
+    # are fresh for `ttl` seconds, stale ones are revalidated with
+    # If-None-Match / If-Modified-Since when the server sent validators.
+    # The least recently used entries go once the cache outgrows `max_bytes`.
+    def __init__(self, fname='http_cache.sqlite', max_bytes=1 << 30, ttl=24 * 3600):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._lock = Lock()
+        self._db = sqlite3.connect(fname, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                status INTEGER,
+                body BLOB,
+                encoding TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                stored_at REAL,
+                accessed_at REAL,
+                size INTEGER
+            )
+        ''')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)'
+        )
+        self._size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses'
+        ).fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    @staticmethod
+    def key(method, url, data=None):
+        h = hashlib.sha256(f'{method} {url}\n'.encode())
+        if isinstance(data, str):
+            data = data.encode()
+        elif data is not None and not isinstance(data, bytes):
+            data = json.dumps(data, sort_keys=True).encode()
+        if data:
+            h.update(data)
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT status, body, encoding, etag, last_modified, stored_at '
+                'FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                'UPDATE responses SET accessed_at = ? WHERE key = ?', (time(), key)
+            )
+        return CachedResponse(*row)
+
+    def is_fresh(self, entry: CachedResponse):
+        return time() - entry.stored_at < self._ttl
+
+    @staticmethod
+    def validators(entry: CachedResponse):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def revalidated(self, key):
+        with self._lock:
+            self._db.execute(
+                'UPDATE responses SET stored_at = ? WHERE key = ?', (time(), key)
+            )
+
+    def put(self, key, status, body: bytes, encoding, headers):
+        if status not in CACHEABLE_STATUS or len(body) > self._max_bytes:
+            return
+        now = time()
+        with self._lock:
+            old = self._db.execute(
+                'SELECT size FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+                    key, status, body, encoding,
+                    headers.get('ETag'), headers.get('Last-Modified'),
+                    now, now, len(body)
+                )
+            )
+            self._size += len(body) - (old[0] if old else 0)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drops least recently used entries down to 90% of the budget
+        target = self._max_bytes * .9
+        while self._size > target:
+            rows = self._db.execute(
+                'SELECT key, size FROM responses ORDER BY accessed_at LIMIT 256'
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._size -= size
+                if self._size <= target:
+                    break
@@ -1,36 +1,37 @@
-from json import JSONDecodeError
+import json
 
-from tqdm import tqdm
+from pipeline import JobSpec, run_job
 
-from scrape import *
-from storage import *
 
+def _is_record(body: bytes):
+    return body[:1] == b'{' and body.rstrip()[-1:] == b'}'
 
-def process_melissa():
+
+def _is_block_page(body: bytes):
+    return not body.lstrip().startswith(b'{') and b'<a href="/v2/lookups/zip4/zip4/' not in body
+
+
+def _is_error(body: bytes):
+    return b'<a href="/v2/lookups/zip4/zip4/' in body
+
+
+def _zip4_items():
     with open('zip4.json', 'r') as f:
-        rr = json.load(f)
-
-    errors = 0
-    with JSONStorage('j') as stor:
-        # stor.clear_errors()
-        total_len = len(rr)
-        rr = tuple(stor.filter_items(rr))
-        filtered_len = total_len - len(rr)
-        counter = tqdm(map_scrape_get(
-            'https://www.melissa.com/v2/lookups/zip4/zip4/?zip4={}&tbl=mak&fmt=json',
-            rr
-        ), total=total_len)
-        counter.update(filtered_len)
-        for n, v in counter:
-            if ' ' not in n:
-                try:
-                    v = json.loads(v)
-                    stor.store_item(n, v)
-                    errors = 0
-                except JSONDecodeError:
-                    print(n)
-                    if '<a href="/v2/lookups/zip4/zip4/' in v:
-                        stor.mark_err(n)
-                    errors += 1
-                    if errors > 32:
-                        break
+        return [i for i in json.load(f) if ' ' not in i]
+
+
+MELISSA = JobSpec(
+    name='j',
+    url_template='https://www.melissa.com/v2/lookups/zip4/zip4/?zip4={}&tbl=mak&fmt=json',
+    items=_zip4_items,
+    is_record=_is_record,
+    is_block_page=_is_block_page,
+    is_error=_is_error,
+    threads=64,
+    initial_limit=4,
+    max_errors=32,
+)
+
+
+def process_melissa(parse_workers=None, shard=0, shards=1):
+    run_job(MELISSA, parse_workers, shard=shard, shards=shards)
@@ -0,0 +1,157 @@
+import json
+import os
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from time import time
+
+# Upper bounds in seconds, growing by 2 ** .25 (~19%) from .1ms to ~14 minutes
+LATENCY_BUCKETS = tuple(.0001 * 2 ** (i / 4) for i in range(93))
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._count = 0
+        self._sum = 0.
+
+    def observe(self, v):
+        self._counts[bisect_left(self._bounds, v)] += 1
+        self._count += 1
+        self._sum += v
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self._count:
+            return None
+        rank = q * self._count
+        seen = 0
+        for bound, c in zip(self._bounds, self._counts):
+            seen += c
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self._count,
+            'sum': self._sum,
+            'p50': self.quantile(.5),
+            'p90': self.quantile(.9),
+            'p99': self.quantile(.99),
+            'buckets': {
+                str(bound): c
+                for bound, c in zip(self._bounds + ('inf',), self._counts) if c
+            },
+        }
+
+
+class Metrics:
+    # Process wide counters, gauges and latency histograms. Names are dotted,
+    # e.g. `http.status.200` or `storage.write_latency`.
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = Counter()
+        self._gauges = Counter()
+        self._histograms = {}
+        self._started = time()
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def add(self, name, delta):
+        with self._lock:
+            self._gauges[name] += delta
+
+    def observe(self, name, value):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram()
+            h.observe(value)
+
+    def record_response(self, latency, status, body):
+        # `body` is the raw response bytes, a FetchError when the request raised
+        with self._lock:
+            self._counters['http.requests'] += 1
+            if status is None:
+                self._counters[f'http.errors.{body.exc_type}'] += 1
+            else:
+                self._counters[f'http.status.{status}'] += 1
+                self._counters['http.bytes'] += len(body)
+            h = self._histograms.get('http.latency')
+            if h is None:
+                h = self._histograms['http.latency'] = Histogram()
+            h.observe(latency)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._started = time()
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time() - self._started
+            return {
+                'time': time(),
+                'elapsed': elapsed,
+                'rates': {
+                    k: v / elapsed for k, v in self._counters.items()
+                    if k in ('http.requests', 'http.bytes', 'storage.writes', 'storage.bytes')
+                } if elapsed else {},
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges),
+                'histograms': {k: h.snapshot() for k, h in self._histograms.items()},
+            }
+
+    def write(self, fname):
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(fname + '.tmp', fname)
+
+    @contextmanager
+    def flushing(self, fname, interval=10.):
+        # Rewrites `fname` every `interval` seconds while the block runs
+        stop = Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.write(fname)
+
+        t = Thread(target=run, daemon=True)
+        t.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            t.join()
+            self.write(fname)
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        # Serves the snapshot as JSON on http://host:port/, returns the
+        # server so the caller can shutdown() it
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot(), indent=1).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+METRICS = Metrics()
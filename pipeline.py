@@ -0,0 +1,210 @@
+import os
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures.process import ProcessPoolExecutor
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Callable, Sequence
+
+from tqdm import tqdm
+
+from metrics import METRICS
+from proxy_pool import ProxyPool
+from retry import FetchError, RetryPolicy
+from scrape import map_scrape_get
+from setting import get_proxy_urls
+from sharding import select_shard, shard_name
+from storage import JSONStorage
+from throttle import HostThrottle
+
+RECORD = 'record'
+NOT_FOUND = 'notfound'
+ERROR = 'err'
+
+_DONE = object()
+
+
+@dataclass
+class JobSpec:
+    # One scraped dataset: `items()` lists what to fetch, each item is
+    # formatted into `url_template` and stored under `key(item)` in the
+    # JSONStorage `name`. Predicates get the raw response body. `parses`
+    # names the ones that parse it, those run in worker processes and must
+    # be module level functions.
+    name: str
+    url_template: str
+    items: Callable[[], Sequence[str]]
+    is_record: Callable[[bytes], bool]
+    is_block_page: Callable[[bytes], bool]
+    key: Callable[[str], str] = str
+    is_not_found: Callable[[bytes], bool] = None
+    is_error: Callable[[bytes], bool] = None
+    threads: int = 64
+    initial_limit: int = 4
+    backend: str = 'threads'
+    max_errors: int = 32
+    parses: Sequence[str] = ()
+
+
+def _checks(spec: JobSpec):
+    # (code, predicate) pairs in classification order, split before the
+    # first predicate that parses the body
+    checks = []
+    for code, name in (RECORD, 'is_record'), (NOT_FOUND, 'is_not_found'), (ERROR, 'is_error'):
+        check = getattr(spec, name)
+        if check is not None:
+            checks.append((name, code, check))
+    split = next((i for i, c in enumerate(checks) if c[0] in spec.parses), len(checks))
+    return [c[1:] for c in checks[:split]], [c[1:] for c in checks[split:]]
+
+
+def _classify(checks, bodies):
+    codes = []
+    for body in bodies:
+        for code, check in checks:
+            if check(body):
+                codes.append(code)
+                break
+        else:
+            codes.append(None)
+    return codes
+
+
+def _completed(fn, *args):
+    f = Future()
+    f.set_result(fn(*args))
+    return f
+
+
+def _put(out: Queue, r, stop: Event):
+    while not stop.is_set():
+        try:
+            out.put(r, timeout=.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _fetch_stage(spec: JobSpec, items, out: Queue, stop: Event):
+    results = map_scrape_get(
+        spec.url_template, items, threads=spec.threads, backend=spec.backend,
+        throttle=HostThrottle(
+            spec.is_block_page, initial=spec.initial_limit, max_limit=spec.threads
+        ),
+        proxies=ProxyPool(get_proxy_urls(), spec.is_block_page),
+        ordered=False, retry=RetryPolicy(retry_body=spec.is_block_page), raw=True
+    )
+    try:
+        for r in results:
+            if not _put(out, r, stop):
+                return
+        _put(out, _DONE, stop)
+    except Exception as e:
+        _put(out, e, stop)
+    finally:
+        results.close()
+
+
+def _batches(fetched: Queue, size):
+    # Blocks for the first result only, then takes whatever is already queued
+    while True:
+        r = fetched.get()
+        batch = []
+        while True:
+            if r is _DONE:
+                if batch:
+                    yield batch
+                return
+            if isinstance(r, Exception):
+                raise r
+            batch.append(r)
+            if len(batch) >= size:
+                break
+            try:
+                r = fetched.get_nowait()
+            except Empty:
+                break
+        yield batch
+
+
+def run_job(
+        spec: JobSpec, parse_workers=None, queue_size=1024, batch=64,
+        shard=0, shards=1, shard_method='hash'
+):
+    # Fetching runs in threads (or asyncio) feeding a bounded queue and the
+    # calling thread classifies bodies and is the only one writing the
+    # store. Bodies left to the spec's parsing predicates go to
+    # `parse_workers` processes (0 classifies everything inline).
+    # With `shards` > 1 only the items of `shard` are fetched, into their own
+    # store for sharding.merge_shards.
+    inline, parsing = _checks(spec)
+    name = shard_name(spec.name, shard, shards)
+    with JSONStorage(name) as stor, METRICS.flushing(f'{stor.path}/metrics.json'):
+        items = select_shard(spec.items(), spec.key, shard, shards, shard_method)
+        todo = [i for i in items if not stor.has_item(spec.key(i))]
+        counter = tqdm(total=len(items))
+        counter.update(len(items) - len(todo))
+
+        fetched = Queue(queue_size)
+        stop = Event()
+        fetcher = Thread(target=_fetch_stage, args=(spec, todo, fetched, stop), daemon=True)
+        fetcher.start()
+        if parse_workers is None:
+            parse_workers = os.cpu_count()
+        pool = ProcessPoolExecutor(parse_workers) if parse_workers and parsing else None
+        submit = pool.submit if pool is not None else _completed
+        max_pending = 2 * max(parse_workers, 1)
+
+        errors = 0
+
+        def classified(codes, f):
+            parsed = iter(f.result())
+            return [next(parsed) if code is None else code for code in codes]
+
+        def store(results, codes):
+            nonlocal errors
+            codes = iter(codes)
+            for item, body in results:
+                counter.update(1)
+                key = spec.key(item)
+                if isinstance(body, FetchError):
+                    stor.mark_err(key, body.reason())
+                    print(key, body)
+                else:
+                    code = next(codes)
+                    if code == RECORD:
+                        stor.store_raw(key, body)
+                        errors = 0
+                        continue
+                    if code == NOT_FOUND:
+                        stor.mark_notfound(key)
+                    elif code == ERROR:
+                        stor.mark_err(key)
+                    else:
+                        print(key, body[:200])
+                errors += 1
+
+        pending = deque()
+        try:
+            for results in _batches(fetched, batch):
+                bodies = [body for _, body in results if not isinstance(body, FetchError)]
+                codes = _classify(inline, bodies)
+                rest = [body for body, code in zip(bodies, codes) if code is None]
+                f = submit(_classify, parsing, rest) if rest else _completed(list)
+                pending.append((results, codes, f))
+                while pending and (len(pending) > max_pending or pending[0][2].done()):
+                    results, codes, f = pending.popleft()
+                    store(results, classified(codes, f))
+                if errors > spec.max_errors:
+                    break
+            while pending and errors <= spec.max_errors:
+                results, codes, f = pending.popleft()
+                store(results, classified(codes, f))
+        finally:
+            stop.set()
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            counter.close()
+        fetcher.join()
@@ -0,0 +1,124 @@
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from throttle import is_failure
+
+
+class _Proxy:
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.error_rate = 0.
+        self.in_flight = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.
+
+
+class Lease:
+    def __init__(self, url):
+        self.url = url
+        self.proxies = {'http': url, 'https': url}
+        self.status = None
+        self.body = None
+
+    def done(self, status, body):
+        self.status = status
+        self.body = body
+
+
+class ProxyPool:
+    # Spreads requests over several proxies (e.g. one per local Tor instance).
+    # Each request goes to the better of two random healthy proxies, scored
+    # by smoothed latency, error rate and requests already in flight.
+    # `eject_after` consecutive failures take a proxy out for `eject_for`
+    # seconds, doubling up to `max_eject_for` while it keeps failing after
+    # being rotated back in.
+    def __init__(
+            self, urls, error_page=None, alpha=.1,
+            eject_after=5, eject_for=30., max_eject_for=600.
+    ):
+        self._proxies = {url: _Proxy(url) for url in urls}
+        if not self._proxies:
+            raise ValueError('Empty proxy pool')
+        self._error_page = error_page
+        self._alpha = alpha
+        self._eject_after = eject_after
+        self._eject_for = eject_for
+        self._max_eject_for = max_eject_for
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return tuple(self._proxies)
+
+    @staticmethod
+    def _score(p: _Proxy, default_latency):
+        # Proxies without a successful request yet count with the pool's
+        # mean latency, so their errors and in-flight requests still weigh
+        latency = default_latency if p.latency is None else p.latency
+        return latency * (p.in_flight + 1) / max(1. - p.error_rate, .05)
+
+    def _mean_latency(self):
+        measured = [p.latency for p in self._proxies.values() if p.latency is not None]
+        return sum(measured) / len(measured) if measured else 1.
+
+    def _acquire(self):
+        now = monotonic()
+        with self._lock:
+            healthy = [p for p in self._proxies.values() if p.ejected_until <= now]
+            if not healthy:
+                healthy = [min(self._proxies.values(), key=lambda p: p.ejected_until)]
+            if len(healthy) > 2:
+                healthy = random.sample(healthy, 2)
+            default_latency = self._mean_latency()
+            p = min(healthy, key=lambda p: self._score(p, default_latency))
+            p.in_flight += 1
+            return p
+
+    def _release(self, p: _Proxy, latency, status, body):
+        failed = is_failure(status, body, self._error_page)
+        with self._lock:
+            p.in_flight -= 1
+            p.error_rate += self._alpha * (failed - p.error_rate)
+            if not failed:
+                if p.latency is None:
+                    p.latency = latency
+                else:
+                    p.latency += self._alpha * (latency - p.latency)
+                p.failures = 0
+                p.ejections = 0
+                return
+            p.failures += 1
+            if p.failures >= self._eject_after:
+                p.ejected_until = monotonic() + min(
+                    self._eject_for * 2 ** p.ejections, self._max_eject_for
+                )
+                p.ejections += 1
+                # One more failure after rotating back in ejects it again
+                p.failures = self._eject_after - 1
+
+    @contextmanager
+    def lease(self):
+        # The caller reports the response with `lease.done(status, body)`,
+        # a lease left without one counts as a failed request
+        p = self._acquire()
+        lease = Lease(p.url)
+        t = monotonic()
+        try:
+            yield lease
+        finally:
+            self._release(p, monotonic() - t, lease.status, lease.body)
+
+    def stats(self):
+        now = monotonic()
+        with self._lock:
+            return [{
+                'url': p.url,
+                'latency': p.latency,
+                'error_rate': p.error_rate,
+                'in_flight': p.in_flight,
+                'ejected_for': max(0., p.ejected_until - now),
+            } for p in self._proxies.values()]
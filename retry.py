@@ -0,0 +1,70 @@
+import json
+import random
+
+PERMANENT_EXCEPTIONS = (
+    'InvalidURL', 'InvalidSchema', 'MissingSchema', 'InvalidUrlClientError', 'ValueError'
+)
+
+
+class FetchError(str):
+    # Behaves like the old 'error: ...' body strings, but keeps the
+    # failure details for retry decisions and status records.
+    def __new__(cls, status=None, exc_type='', message='', attempts=1):
+        if exc_type:
+            text = f'error: {exc_type} {message}'
+        else:
+            text = f'error: status {status} {message}'
+        self = super().__new__(cls, text)
+        self.status = status
+        self.exc_type = exc_type
+        self.message = message
+        self.attempts = attempts
+        return self
+
+    @classmethod
+    def from_exception(cls, e: Exception):
+        return cls(exc_type=e.__class__.__name__, message=str(e))
+
+    def with_attempts(self, attempts):
+        return FetchError(self.status, self.exc_type, self.message, attempts)
+
+    def reason(self):
+        return json.dumps({
+            'status': self.status,
+            'exc': self.exc_type,
+            'message': self.message[:200],
+            'attempts': self.attempts,
+        })
+
+
+class RetryPolicy:
+    def __init__(
+            self, attempts=5, backoff=1., max_backoff=300.,
+            retry_status=(408, 425, 429, 500, 502, 503, 504), retry_body=None
+    ):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_status = frozenset(retry_status)
+        self.retry_body = retry_body
+
+    def failure(self, status, body):
+        if isinstance(body, FetchError):
+            if body.exc_type in PERMANENT_EXCEPTIONS:
+                return body, False
+            return body, True
+        if status in self.retry_status:
+            message = body[:200]
+            if isinstance(message, bytes):
+                message = message.decode('utf-8', 'replace')
+            return FetchError(status, message=message), True
+        if self.retry_body is not None and self.retry_body(body):
+            return FetchError(status, message='error page'), True
+        return None, False
+
+    def accepts(self, status, body):
+        return self.failure(status, body)[0] is None
+
+    def delay(self, attempt):
+        d = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return d * random.uniform(.5, 1.)
@@ -1,47 +1,258 @@
+from concurrent.futures import FIRST_COMPLETED, wait
 from concurrent.futures.thread import ThreadPoolExecutor
 from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+from time import monotonic, sleep
 from urllib.parse import urlencode
 
 import requests
 
+from http_cache import ResponseCache
+from metrics import METRICS
+from proxy_pool import ProxyPool
+from retry import FetchError, RetryPolicy
 from setting import get_headers, get_proxies
+from throttle import HostThrottle, is_failure
 
 
 class RequestHandler:
-    def __init__(self, headers=(), proxies=()):
+    # `proxies` is a requests style proxies dict or a ProxyPool. With a
+    # `cache`, only responses passing `cacheable(status, body)` are stored
+    # or served, `body` being what the caller gets back.
+    def __init__(self, headers=(), proxies=(), cache: ResponseCache = None, cacheable=None):
         self._headers = dict(headers) or get_headers()
-        self._proxies = dict(proxies) or get_proxies()
+        if isinstance(proxies, ProxyPool):
+            self._proxies = proxies
+        else:
+            self._proxies = dict(proxies) or get_proxies()
+        self._cache = cache
+        self._cacheable = cacheable
 
-    def get(self, url, params=()):
+    def _accepts(self, status, body):
+        return self._cacheable is None or self._cacheable(status, body)
+
+    def request(self, method, url, params=(), data=None, raw=False):
+        METRICS.add('http.in_flight', 1)
+        t = monotonic()
+        try:
+            status, body, sent = self._request(method, url, params, data, raw)
+        finally:
+            METRICS.add('http.in_flight', -1)
+        # Cache hits only count as http.cache_hits
+        if sent is not None:
+            METRICS.record_response(monotonic() - t, *sent)
+        return status, body
+
+    def _request(self, method, url, params, data, raw):
+        # Returns status, body and the status and raw body that came over
+        # the wire, None when served from the cache
         try:
             if params:
                 url += '?' + urlencode(dict(params))
-            r = requests.get(url, headers=self._headers, proxies=self._proxies)
+            if data is None:
+                kwargs = {}
+            elif isinstance(data, (str, bytes)):
+                kwargs = {'data': data}
+            else:
+                kwargs = {'json': data}
+            headers = self._headers
+            entry = None
+            if self._cache is not None:
+                key = self._cache.key(method, url, data)
+                entry = self._cache.get(key)
+                # Entries stored before `cacheable` rejected them are skipped
+                if entry is not None and not self._accepts(entry.status, entry.content(raw)):
+                    entry = None
+                if entry is not None:
+                    if self._cache.is_fresh(entry):
+                        METRICS.inc('http.cache_hits')
+                        return entry.status, entry.content(raw), None
+                    headers = dict(headers, **self._cache.validators(entry))
+            r = self._send(method, url, headers, kwargs)
+            body = r.content if raw else r.text
+            if self._cache is not None:
+                if entry is not None and r.status_code == 304:
+                    METRICS.inc('http.cache_revalidated')
+                    self._cache.revalidated(key)
+                    return entry.status, entry.content(raw), (304, r.content)
+                if self._accepts(r.status_code, body):
+                    self._cache.put(key, r.status_code, r.content, r.encoding, r.headers)
         except Exception as e:
-            return f'error: {e.__class__.__name__} {e}'
-        return r.text
+            err = FetchError.from_exception(e)
+            return None, err, (None, err)
+        return r.status_code, body, (r.status_code, r.content)
+
+    def _send(self, method, url, headers, kwargs):
+        if not isinstance(self._proxies, ProxyPool):
+            return requests.request(
+                method, url, headers=headers, proxies=self._proxies, **kwargs
+            )
+        with self._proxies.lease() as lease:
+            r = requests.request(
+                method, url, headers=headers, proxies=lease.proxies, **kwargs
+            )
+            lease.done(r.status_code, r.content)
+        return r
+
+    def get(self, url, params=()):
+        return self.request('GET', url, params)[1]
 
     def post(self, url, data):
-        try:
-            if isinstance(data, (str, bytes)):
-                r = requests.post(url, data=data, headers=self._headers, proxies=self._proxies)
-            else:
-                r = requests.post(url, json=data, headers=self._headers, proxies=self._proxies)
-        except Exception as e:
-            return f'error: {e.__class__.__name__} {e}'
-        return r.text
+        return self.request('POST', url, data=data)[1]
 
 
-def _get_process_item(req: RequestHandler, url_template, item):
+def _get_process_item(req: RequestHandler, url_template, raw, item):
     url = url_template.format(*item.split('#'))
-    body = req.get(url)
-    return item, body
+    return req.request('GET', url, raw=raw)
+
+
+def _get_process_item_throttled(
+        req: RequestHandler, throttle: HostThrottle, url_template, raw, item
+):
+    url = url_template.format(*item.split('#'))
+    with throttle.gate(url):
+        t = monotonic()
+        status, body = req.request('GET', url, raw=raw)
+        throttle.record(url, monotonic() - t, status, body)
+    return status, body
+
+
+_END = object()
+
+
+class Scheduler:
+    # Backend independent bookkeeping for map_scrape_get: pulls items lazily,
+    # keeps running + delayed + buffered items within `window` and reorders
+    # results when `ordered` is set.
+    def __init__(self, items, window, ordered, retry: RetryPolicy = None):
+        self._items = iter(items)
+        self._exhausted = False
+        self._window = window
+        self._ordered = ordered
+        self._retry = retry
+        self._seq = count()
+        self._next = 0
+        self._running = 0
+        self._ready = {}
+        self._delayed = []
+        self._attempts = {}
+
+    def take(self, now):
+        started = []
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, item = heappop(self._delayed)
+            started.append((seq, item))
+        self._running += len(started)
+        while not self._exhausted and (
+                self._running + len(self._delayed) + len(self._ready) < self._window
+        ):
+            item = next(self._items, _END)
+            if item is _END:
+                self._exhausted = True
+                break
+            self._running += 1
+            started.append((next(self._seq), item))
+        return started
+
+    def complete(self, seq, item, status, body, now):
+        self._running -= 1
+        if self._retry is not None:
+            attempt = self._attempts.pop(seq, 0) + 1
+            err, transient = self._retry.failure(status, body)
+            if err is not None:
+                if transient and attempt < self._retry.attempts:
+                    METRICS.inc('scrape.retries')
+                    self._attempts[seq] = attempt
+                    heappush(self._delayed, (now + self._retry.delay(attempt), seq, item))
+                    return ()
+                METRICS.inc('scrape.failed')
+                body = err.with_attempts(attempt)
+        if not self._ordered:
+            return (item, body),
+        self._ready[seq] = item, body
+        out = []
+        while self._next in self._ready:
+            out.append(self._ready.pop(self._next))
+            self._next += 1
+        return out
+
+    def timeout(self, now):
+        if not self._delayed:
+            return None
+        return max(0., self._delayed[0][0] - now)
+
+    @property
+    def finished(self):
+        return self._exhausted and not self._running and not self._delayed
+
+
+def _map_bounded(pool: ThreadPoolExecutor, fn, sched: Scheduler):
+    futures = {}
+    try:
+        while True:
+            for seq, item in sched.take(monotonic()):
+                futures[pool.submit(fn, item)] = seq, item
+            if not futures:
+                if sched.finished:
+                    break
+                sleep(sched.timeout(monotonic()))
+                continue
+            done, _ = wait(futures, timeout=sched.timeout(monotonic()), return_when=FIRST_COMPLETED)
+            for f in done:
+                seq, item = futures.pop(f)
+                status, body = f.result()
+                yield from sched.complete(seq, item, status, body, monotonic())
+    finally:
+        for f in futures:
+            f.cancel()
+
+
+def cacheable_for(retry: RetryPolicy, throttle: HostThrottle):
+    # Responses that would be retried or count as throttle failures are
+    # not cached, so a retry is never answered with the same failure
+    def cacheable(status, body):
+        if retry is not None and not retry.accepts(status, body):
+            return False
+        return throttle is None or not is_failure(status, body, throttle.error_page)
+    return cacheable
+
+
+def map_scrape_get(
+        url_template, items, threads=4, backend='threads',
+        throttle: HostThrottle = None, ordered=True, window=None,
+        retry: RetryPolicy = None, raw=False, cache: ResponseCache = None,
+        headers=(), proxies=()
+):
+    # With a throttle, `threads` is the upper bound and the actual
+    # concurrency per host is adjusted by the throttle controllers.
+    # `ordered=False` yields results as they complete. With `retry`, transient
+    # failures are requeued with backoff and items that run out of attempts
+    # come back with a FetchError body. `raw=True` yields response bodies as
+    # undecoded bytes. `cache` serves repeated requests from a ResponseCache,
+    # except for responses `retry` or `throttle` would reject.
+    window = window or threads * 4
+    if backend == 'async':
+        from scrape_async import map_scrape_get_async
+        yield from map_scrape_get_async(
+            url_template, items, concurrency=threads, throttle=throttle,
+            ordered=ordered, window=window, retry=retry, raw=raw, cache=cache,
+            headers=headers, proxies=proxies
+        )
+        return
+    if backend != 'threads':
+        raise ValueError(f'Unknown backend {backend}')
+    req = RequestHandler(headers, proxies, cache, cacheable_for(retry, throttle))
+    if throttle is None:
+        process_item = partial(_get_process_item, req, url_template, raw)
+    else:
+        process_item = partial(_get_process_item_throttled, req, throttle, url_template, raw)
+    yield from map_scrape(process_item, items, threads, ordered, window, retry)
 
 
-def map_scrape_get(url_template, items, threads=4):
-    req = RequestHandler()
+def map_scrape(fn, items, threads=4, ordered=True, window=None, retry: RetryPolicy = None):
+    # Thread backend of map_scrape_get for any `fn(item) -> (status, body)`
     with ThreadPoolExecutor(threads) as pool:
-        yield from pool.map(
-            partial(_get_process_item, req, url_template),
-            items
+        yield from _map_bounded(
+            pool, fn, Scheduler(items, window or threads * 4, ordered, retry)
         )
@@ -0,0 +1,250 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from threading import Thread
+from time import monotonic
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp_socks import ProxyConnector
+
+from http_cache import ResponseCache
+from metrics import METRICS
+from proxy_pool import ProxyPool
+from retry import FetchError, RetryPolicy
+from scrape import Scheduler, cacheable_for
+from setting import get_headers, get_proxies
+from throttle import HostThrottle
+
+
+class AsyncRequestHandler:
+    def __init__(
+            self, headers=(), proxies=(), connections=1024, timeout=120,
+            cache: ResponseCache = None, cacheable=None
+    ):
+        self._headers = dict(headers) or get_headers()
+        if isinstance(proxies, ProxyPool):
+            self._proxies = proxies
+        else:
+            self._proxies = dict(proxies) or get_proxies()
+        self._cache = cache
+        self._cacheable = cacheable
+        self._connections = connections
+        self._timeout = timeout
+        self._sessions = {}
+
+    def _connector(self, proxy):
+        if proxy:
+            return ProxyConnector.from_url(
+                proxy, limit=self._connections, limit_per_host=self._connections
+            )
+        return aiohttp.TCPConnector(
+            limit=self._connections, limit_per_host=self._connections
+        )
+
+    async def __aenter__(self):
+        # One session per proxy, a SOCKS connector is bound to its proxy
+        if isinstance(self._proxies, ProxyPool):
+            proxies = self._proxies.urls
+        else:
+            proxies = (self._proxies.get('https') or self._proxies.get('http'),)
+        for proxy in proxies:
+            self._sessions[proxy] = aiohttp.ClientSession(
+                connector=self._connector(proxy),
+                headers=self._headers,
+                timeout=aiohttp.ClientTimeout(total=self._timeout),
+            )
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+    def _accepts(self, status, body):
+        return self._cacheable is None or self._cacheable(status, body)
+
+    async def request(self, method, url, params=(), data=None, raw=False):
+        METRICS.add('http.in_flight', 1)
+        t = monotonic()
+        try:
+            status, body, sent = await self._request(method, url, params, data, raw)
+        finally:
+            METRICS.add('http.in_flight', -1)
+        # Cache hits only count as http.cache_hits
+        if sent is not None:
+            METRICS.record_response(monotonic() - t, *sent)
+        return status, body
+
+    async def _request(self, method, url, params, data, raw):
+        try:
+            if params:
+                url += '?' + urlencode(dict(params))
+            if data is None:
+                kwargs = {}
+            elif isinstance(data, (str, bytes)):
+                kwargs = {'data': data}
+            else:
+                kwargs = {'json': data}
+            headers = {}
+            entry = None
+            if self._cache is not None:
+                key = self._cache.key(method, url, data)
+                entry = self._cache.get(key)
+                if entry is not None and not self._accepts(entry.status, entry.content(raw)):
+                    entry = None
+                if entry is not None:
+                    if self._cache.is_fresh(entry):
+                        METRICS.inc('http.cache_hits')
+                        return entry.status, entry.content(raw), None
+                    headers = self._cache.validators(entry)
+            async with self._send(method, url, headers, kwargs) as r:
+                content = await r.read()
+                body = content if raw else await r.text()
+                if self._cache is not None:
+                    if entry is not None and r.status == 304:
+                        METRICS.inc('http.cache_revalidated')
+                        self._cache.revalidated(key)
+                        return entry.status, entry.content(raw), (304, content)
+                    if self._accepts(r.status, body):
+                        self._cache.put(key, r.status, content, r.charset, r.headers)
+                return r.status, body, (r.status, content)
+        except Exception as e:
+            err = FetchError.from_exception(e)
+            return None, err, (None, err)
+
+    @asynccontextmanager
+    async def _send(self, method, url, headers, kwargs):
+        if not isinstance(self._proxies, ProxyPool):
+            session, = self._sessions.values()
+            async with session.request(method, url, headers=headers, **kwargs) as r:
+                yield r
+            return
+        with self._proxies.lease() as lease:
+            session = self._sessions[lease.url]
+            async with session.request(method, url, headers=headers, **kwargs) as r:
+                lease.done(r.status, await r.read())
+                yield r
+
+    async def get(self, url, params=()):
+        return (await self.request('GET', url, params))[1]
+
+    async def post(self, url, data):
+        return (await self.request('POST', url, data=data))[1]
+
+
+_DONE = object()
+
+
+async def _next_result(results: asyncio.Queue, task: asyncio.Task):
+    getter = asyncio.ensure_future(results.get())
+    await asyncio.wait((getter, task), return_when=asyncio.FIRST_COMPLETED)
+    if getter.done():
+        return getter.result()
+    getter.cancel()
+    if not results.empty():
+        return results.get_nowait()
+    task.result()
+    return _DONE
+
+
+def iterate_in_loop(producer, maxsize):
+    # Runs `producer(results)` on an event loop in a background thread, so
+    # requests keep flowing while the caller processes yielded values.
+    loop = asyncio.new_event_loop()
+    thread = Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def call(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def start():
+        results = asyncio.Queue(maxsize)
+        return results, asyncio.ensure_future(producer(results))
+
+    async def stop():
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    results, task = call(start())
+    try:
+        while True:
+            v = call(_next_result(results, task))
+            if v is _DONE:
+                break
+            yield v
+    finally:
+        call(stop())
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _get_process_item(req: AsyncRequestHandler, url_template, raw, item):
+    url = url_template.format(*item.split('#'))
+    return await req.request('GET', url, raw=raw)
+
+
+async def _get_process_item_throttled(
+        req: AsyncRequestHandler, throttle: HostThrottle, url_template, raw, item
+):
+    url = url_template.format(*item.split('#'))
+    async with throttle.async_gate(url):
+        t = monotonic()
+        status, body = await req.request('GET', url, raw=raw)
+        throttle.record(url, monotonic() - t, status, body)
+    return status, body
+
+
+async def _scrape_get(
+        url_template, concurrency, throttle, raw, req_args, sched: Scheduler,
+        results: asyncio.Queue
+):
+    tasks = {}
+    try:
+        async with AsyncRequestHandler(connections=concurrency, **req_args) as req:
+            while True:
+                for seq, item in sched.take(monotonic()):
+                    if throttle is None:
+                        f = _get_process_item(req, url_template, raw, item)
+                    else:
+                        f = _get_process_item_throttled(req, throttle, url_template, raw, item)
+                    tasks[asyncio.ensure_future(f)] = seq, item
+                if not tasks:
+                    if sched.finished:
+                        break
+                    await asyncio.sleep(sched.timeout(monotonic()))
+                    continue
+                done, _ = await asyncio.wait(
+                    tasks, timeout=sched.timeout(monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                for t in done:
+                    seq, item = tasks.pop(t)
+                    status, body = t.result()
+                    for v in sched.complete(seq, item, status, body, monotonic()):
+                        await results.put(v)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def map_scrape_get_async(
+        url_template, items, concurrency=256, throttle: HostThrottle = None,
+        ordered=False, window=None, retry: RetryPolicy = None, raw=False,
+        cache: ResponseCache = None, headers=(), proxies=()
+):
+    # `concurrency` caps in-flight requests, `window` additionally bounds
+    # the results held for an ordered or slow consumer.
+    window = min(concurrency, window or concurrency)
+    sched = Scheduler(items, window, ordered, retry)
+    req_args = {
+        'cache': cache, 'cacheable': cacheable_for(retry, throttle),
+        'headers': headers, 'proxies': proxies
+    }
+    return iterate_in_loop(
+        lambda results: _scrape_get(
+            url_template, concurrency, throttle, raw, req_args, sched, results
+        ),
+        window
+    )
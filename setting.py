@@ -14,3 +14,14 @@ def get_proxies():
         'http': "socks5://localhost:9150",
         'https': "socks5://localhost:9150"
     }
+
+
+def get_proxy_urls():
+    # One proxy url per line in proxies.txt, e.g. a SocksPort per local
+    # Tor instance, the default Tor browser port without it
+    try:
+        with open('proxies.txt', 'r') as f:
+            urls = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+    except FileNotFoundError:
+        urls = []
+    return urls or [get_proxies()['https']]
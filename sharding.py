@@ -0,0 +1,61 @@
+import argparse
+import zlib
+from bisect import bisect_right
+from os import path
+
+from storage import JSONStorage
+
+METHODS = ('hash', 'range')
+
+
+def shard_name(name, shard, shards):
+    # Store directory of one shard, e.g. `j.3-of-8`
+    if shards == 1:
+        return name
+    return f'{name}.{shard}-of-{shards}'
+
+
+def hash_shard(key, shards):
+    # crc32 instead of hash() so every host and run agrees
+    return zlib.crc32(key.encode()) % shards
+
+
+def range_bounds(keys, shards):
+    # Split points giving `shards` contiguous key ranges of about equal size,
+    # computed from the full key list so every host derives the same ones
+    keys = sorted(keys)
+    return [keys[len(keys) * i // shards] for i in range(1, shards)]
+
+
+def select_shard(items, key, shard, shards, method='hash'):
+    # The items of `items` that belong to `shard` out of `shards`
+    if shards == 1:
+        return list(items)
+    if method == 'hash':
+        return [i for i in items if hash_shard(key(i), shards) == shard]
+    if method == 'range':
+        bounds = range_bounds(map(key, items), shards)
+        return [i for i in items if bisect_right(bounds, key(i)) == shard]
+    raise ValueError(f'Unknown shard method {method}')
+
+
+def merge_shards(dest, sources, backend='files', compression=None):
+    with JSONStorage(dest, backend, compression) as stor:
+        for source in sources:
+            source_backend = 'segments' if path.isdir(path.join(source, 'segments')) else 'files'
+            with JSONStorage(source, source_backend) as other:
+                print(source, stor.merge(other))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge shard stores into one')
+    parser.add_argument('dest', help='store to merge into, created if missing')
+    parser.add_argument('sources', nargs='+', help='shard stores')
+    parser.add_argument('--backend', default='files')
+    parser.add_argument('--compression')
+    args = parser.parse_args()
+    merge_shards(args.dest, args.sources, args.backend, args.compression)
+
+
+if __name__ == '__main__':
+    main()
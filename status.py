@@ -0,0 +1,321 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from array import array
+from collections.abc import KeysView, MutableMapping
+from heapq import merge
+from operator import itemgetter
+
+_MAGIC = b'JSTATUS1'
+_HEADER = struct.Struct('<8sQQQQ')
+_INT = 0
+_STR = 1
+_DELETED = object()
+_MISSING = object()
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class PackedStatus:
+    # Read-only memory-mapped status snapshot. Keys are stored sorted by their
+    # UTF-8 bytes in one blob with offset, state and value arrays next to it,
+    # plus a crc32 keyed open addressing table for point lookups. String
+    # values (err/notfound reasons) are deduplicated into a message list.
+    def __init__(self, fname):
+        self._f = open(fname, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self._mm)
+        magic, n, table_size, blob_len, messages_len = _HEADER.unpack_from(mv, 0)
+        if magic != _MAGIC:
+            raise ValueError(f'{fname} is not a status snapshot')
+        o = _HEADER.size
+        self._offsets = mv[o:o + 8 * (n + 1)].cast('Q')
+        o += 8 * (n + 1)
+        self._values = mv[o:o + 8 * n].cast('q')
+        o += 8 * n
+        self._states = mv[o:o + n]
+        o += _align(n)
+        self._table = mv[o:o + 8 * table_size].cast('Q')
+        o += 8 * table_size
+        self._blob = mv[o:o + blob_len]
+        o += blob_len
+        self._messages = json.loads(bytes(mv[o:o + messages_len]))
+        self._n = n
+        self._mask = table_size - 1
+
+    def close(self):
+        for v in (self._offsets, self._values, self._states, self._table, self._blob):
+            v.release()
+        self._mm.close()
+        self._f.close()
+
+    @staticmethod
+    def write(fname, items):
+        # `items` yields (key bytes, value) sorted by key
+        offsets = array('Q', [0])
+        values = array('q')
+        states = bytearray()
+        hashes = array('L')
+        blob = bytearray()
+        messages = {}
+        for kb, v in items:
+            blob += kb
+            offsets.append(len(blob))
+            if isinstance(v, int):
+                states.append(_INT)
+                values.append(v)
+            else:
+                states.append(_STR)
+                values.append(messages.setdefault(v, len(messages)))
+            hashes.append(zlib.crc32(kb))
+
+        n = len(values)
+        table_size = 1
+        while table_size < 2 * n:
+            table_size *= 2
+        mask = table_size - 1
+        table = array('Q', bytes(8 * table_size))
+        for idx, h in enumerate(hashes):
+            i = h & mask
+            while table[i]:
+                i = (i + 1) & mask
+            table[i] = idx + 1
+        messages = json.dumps(list(messages)).encode()
+
+        tmp_fname = f'{fname}.tmp'
+        with open(tmp_fname, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, n, table_size, len(blob), len(messages)))
+            f.write(offsets.tobytes())
+            f.write(values.tobytes())
+            f.write(states + bytes(_align(n) - n))
+            f.write(table.tobytes())
+            f.write(blob)
+            f.write(messages)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, fname)
+
+    def __len__(self):
+        return self._n
+
+    def key(self, idx) -> bytes:
+        return bytes(self._blob[self._offsets[idx]:self._offsets[idx + 1]])
+
+    def value(self, idx):
+        v = self._values[idx]
+        if self._states[idx] == _INT:
+            return v
+        return self._messages[v]
+
+    def find(self, kb: bytes):
+        i = zlib.crc32(kb) & self._mask
+        while True:
+            v = self._table[i]
+            if not v:
+                return -1
+            if self._blob[self._offsets[v - 1]:self._offsets[v]] == kb:
+                return v - 1
+            i = (i + 1) & self._mask
+
+    def lower_bound(self, kb: bytes):
+        lo, hi = 0, self._n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < kb:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def items(self, start=0):
+        for idx in range(start, self._n):
+            yield self.key(idx), self.value(idx)
+
+
+class JournaledStatus(MutableMapping):
+    # Status map made of a packed, memory-mapped snapshot (`{fname}.bin`) and
+    # an in-memory overlay of the changes since, each of which is appended
+    # to `{fname}.journal` as it happens. The overlay is merged into a new
+    # snapshot once the journal grows comparable to the snapshot or the
+    # overlay reaches `max_overlay` keys.
+    def __init__(self, fname, fsync=False, compact_min=65536, max_overlay=1 << 20):
+        self._fname = f'{fname}.bin'
+        self._journal_fname = f'{fname}.journal'
+        self._fsync = fsync
+        self._compact_min = compact_min
+        self._max_overlay = max_overlay
+        self._overlay = {}
+
+        if not os.path.isfile(self._fname):
+            PackedStatus.write(self._fname, ())
+        self._base = PackedStatus(self._fname)
+        self._len = len(self._base)
+
+        legacy = self._load_legacy(f'{fname}.json')
+        self._journal_len, torn = self._replay(self._journal_fname)
+        self._journal = open(self._journal_fname, 'a')
+        if torn:
+            self._journal.write('\n')
+        if legacy:
+            self.compact()
+            for legacy_fname in legacy:
+                os.unlink(legacy_fname)
+
+    def _load_legacy(self, fname):
+        # Stores written before the packed snapshot kept a plain JSON map
+        found = []
+        try:
+            with open(fname, 'r') as f:
+                for k, v in json.load(f).items():
+                    self._apply(k, v)
+            found.append(fname)
+        except FileNotFoundError:
+            pass
+        if os.path.isfile(f'{fname}.journal'):
+            self._replay(f'{fname}.journal')
+            found.append(f'{fname}.journal')
+        return found
+
+    def _replay(self, fname):
+        n = 0
+        torn = False
+        try:
+            with open(fname, 'r') as f:
+                for l in f:
+                    torn = not l.endswith('\n')
+                    try:
+                        rec = json.loads(l)
+                    except ValueError:
+                        # torn write from a crash, only possible on the last line
+                        continue
+                    if len(rec) == 2:
+                        self._apply(rec[0], rec[1])
+                    else:
+                        self._apply(rec[0], _DELETED)
+                    n += 1
+        except FileNotFoundError:
+            pass
+        return n, torn
+
+    def _in_base(self, k):
+        return self._base.find(k.encode()) >= 0
+
+    def _apply(self, k, v):
+        present = k in self
+        if v is _DELETED:
+            if k in self._overlay and not self._in_base(k):
+                del self._overlay[k]
+            elif present:
+                self._overlay[k] = _DELETED
+            self._len -= present
+        else:
+            self._overlay[k] = v
+            self._len += not present
+
+    def _new_keys(self):
+        # Overlay keys the snapshot does not have
+        for k, v in self._overlay.items():
+            if v is not _DELETED and not self._in_base(k):
+                yield k
+
+    def _append(self, rec):
+        self._journal.write(json.dumps(rec) + '\n')
+        self._journal.flush()
+        if self._fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_len += 1
+        if (
+                self._journal_len > max(self._compact_min, len(self._base))
+                or len(self._overlay) >= self._max_overlay
+        ):
+            self.compact()
+
+    def _merged(self):
+        for kb, v in self._base.items():
+            o = self._overlay.get(kb.decode(), _MISSING)
+            if o is _MISSING:
+                yield kb, v
+            elif o is not _DELETED:
+                yield kb, o
+
+    def compact(self):
+        new = sorted((k.encode(), self._overlay[k]) for k in self._new_keys())
+        PackedStatus.write(self._fname, merge(self._merged(), new, key=itemgetter(0)))
+        # Iterators may still walk the old snapshot, its map is unmapped
+        # once the last of them lets go of it
+        self._base = PackedStatus(self._fname)
+        self._overlay.clear()
+        self._journal.close()
+        self._journal = open(self._journal_fname, 'w')
+        self._journal_len = 0
+
+    def close(self):
+        self._journal.close()
+        self._base.close()
+
+    def __getitem__(self, k):
+        v = self._overlay.get(k, _MISSING)
+        if v is _MISSING:
+            idx = self._base.find(k.encode())
+            if idx < 0:
+                raise KeyError(k)
+            return self._base.value(idx)
+        if v is _DELETED:
+            raise KeyError(k)
+        return v
+
+    def __setitem__(self, k, v):
+        self._apply(k, v)
+        self._append([k, v])
+
+    def __delitem__(self, k):
+        if k not in self:
+            raise KeyError(k)
+        self._apply(k, _DELETED)
+        self._append([k])
+
+    def __contains__(self, k):
+        v = self._overlay.get(k, _MISSING)
+        if v is _MISSING:
+            return self._base.find(k.encode()) >= 0
+        return v is not _DELETED
+
+    def __iter__(self):
+        base = self._base
+        for kb, _ in base.items():
+            k = kb.decode()
+            if self._overlay.get(k) is not _DELETED:
+                yield k
+        yield from list(self._new_keys())
+
+    def __len__(self):
+        return self._len
+
+    def _base_prefix(self, prefix):
+        pb = prefix.encode()
+        base = self._base
+        idx = base.lower_bound(pb)
+        while idx < len(base):
+            kb = base.key(idx)
+            if not kb.startswith(pb):
+                break
+            k = kb.decode()
+            if self._overlay.get(k) is not _DELETED:
+                yield k
+            idx += 1
+
+    def keys(self, prefix=None):
+        # Prefix queries cost a binary search in the snapshot plus one pass
+        # over the overlay, which max_overlay keeps bounded
+        if prefix is None:
+            return KeysView(self)
+        keys = list(self._base_prefix(prefix))
+        keys.extend(
+            k for k, v in self._overlay.items()
+            if v is not _DELETED and k.startswith(prefix) and not self._in_base(k)
+        )
+        return keys
@@ -1,87 +1,412 @@
 import json
+import lzma
+import mmap
 import os
+import shutil
+import struct
 import tarfile
-from contextlib import contextmanager
+from collections import deque
+from concurrent.futures.thread import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
+from itertools import islice
 from os import path, unlink
 from os.path import isfile
+from time import monotonic
 
+from compression import RecordCodec
+from metrics import METRICS
+from status import JournaledStatus
 
-@contextmanager
-def preserve_status(fname, data_creator=dict):
-    try:
-        with open(fname, 'r') as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        data = data_creator()
 
-    try:
-        yield data
-    finally:
-        with open(fname, 'w') as f:
-            json.dump(data, f)
+class FileBackend:
+    # One `{d}/{name}.json` file per record
+    def __init__(self, d):
+        self._d = d
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def buffered(self):
+        return 0
+
+    def _format_path(self, name):
+        return f'{self._d}/{name}.json'
+
+    def exists(self, name):
+        return isfile(self._format_path(name))
+
+    def write(self, name, data: bytes):
+        with open(self._format_path(name), 'wb') as f:
+            f.write(data)
+
+    def read(self, name) -> bytes:
+        with open(self._format_path(name), 'rb') as f:
+            return f.read()
+
+    def delete(self, name):
+        unlink(self._format_path(name))
+
+
+class SegmentBackend:
+    # Records appended to large `segments/seg_NNNNN.dat` files, located
+    # through an append-only `segments/index.log` of name, segment,
+    # offset and length. Writes are buffered and flushed in batches.
+    _header = struct.Struct('<II')
+
+    def __init__(self, d, segment_size=1 << 30, batch_bytes=1 << 20):
+        self._d = path.join(d, 'segments')
+        self._segment_size = segment_size
+        self._batch_bytes = batch_bytes
+        self._index = {}
+        self._maps = {}
+        self._buffer = {}
+        self._buffer_bytes = 0
+
+    def _segment_path(self, n):
+        return path.join(self._d, f'seg_{n:05d}.dat')
+
+    def open(self):
+        os.makedirs(self._d, exist_ok=True)
+        index_fname = path.join(self._d, 'index.log')
+        # Length of the complete lines, a crash can leave the last one cut off
+        complete = None
+        try:
+            with open(index_fname, 'rb') as f:
+                size = 0
+                for l in f:
+                    if not l.endswith(b'\n'):
+                        complete = size
+                        break
+                    size += len(l)
+                    rec = l.decode().rstrip('\n').split('\t')
+                    if len(rec) == 4:
+                        self._index[rec[0]] = int(rec[1]), int(rec[2]), int(rec[3])
+                    elif len(rec) == 1 and rec[0]:
+                        self._index.pop(rec[0], None)
+        except FileNotFoundError:
+            pass
+        if complete is not None:
+            os.truncate(index_fname, complete)
+        self._index_file = open(index_fname, 'a')
+
+        self._segment = 0
+        while isfile(self._segment_path(self._segment + 1)):
+            self._segment += 1
+        self._segment_file = open(self._segment_path(self._segment), 'ab')
+
+    def close(self):
+        self.flush()
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+        self._segment_file.close()
+        self._index_file.close()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._segment_file.tell() >= self._segment_size:
+            self._segment_file.close()
+            self._segment += 1
+            self._segment_file = open(self._segment_path(self._segment), 'ab')
+
+        chunks = []
+        index = []
+        offset = self._segment_file.tell()
+        for name, data in self._buffer.items():
+            bname = name.encode()
+            chunks.append(self._header.pack(len(bname), len(data)))
+            chunks.append(bname)
+            chunks.append(data)
+            offset += self._header.size + len(bname)
+            index.append((name, offset, len(data)))
+            offset += len(data)
+        self._segment_file.write(b''.join(chunks))
+        self._segment_file.flush()
+
+        self._index_file.write(''.join(
+            f'{name}\t{self._segment}\t{offset}\t{length}\n'
+            for name, offset, length in index
+        ))
+        self._index_file.flush()
+        for name, offset, length in index:
+            self._index[name] = self._segment, offset, length
+        self._buffer.clear()
+        self._buffer_bytes = 0
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def exists(self, name):
+        return name in self._buffer or name in self._index
+
+    def write(self, name, data: bytes):
+        if '\t' in name or '\n' in name:
+            raise ValueError(f'Invalid record name {name!r}')
+        self._buffer[name] = data
+        self._buffer_bytes += len(data)
+        if self._buffer_bytes >= self._batch_bytes:
+            self.flush()
+
+    def _map(self, segment, end):
+        m = self._maps.get(segment)
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = m
+        return m
+
+    def read(self, name) -> bytes:
+        if name in self._buffer:
+            return self._buffer[name]
+        try:
+            segment, offset, length = self._index[name]
+        except KeyError:
+            raise FileNotFoundError(name) from None
+        return self._map(segment, offset + length)[offset:offset + length]
+
+    def delete(self, name):
+        if self._buffer.pop(name, None) is None and name not in self._index:
+            raise FileNotFoundError(name)
+        if self._index.pop(name, None) is not None:
+            self._index_file.write(f'{name}\n')
+            self._index_file.flush()
+
+
+BACKENDS = {
+    'files': FileBackend,
+    'segments': SegmentBackend,
+}
 
 
 class JSONStorage:
-    def __init__(self, d):
+    def __init__(self, d, backend='files', compression=None, **backend_args):
         self._d = d
+        self._backend = BACKENDS[backend](d, **backend_args)
+        self._codec = RecordCodec(d, compression)
+        self._manifest = None
+        # Statuses of records still buffered by the backend
+        self._pending = {}
 
     def __enter__(self):
         os.makedirs(self._d, exist_ok=True)
-        self._status_mgr = preserve_status(f'{self._d}/status.json')
-        self._status = self._status_mgr.__enter__()
+        self._status = JournaledStatus(f'{self._d}/status')
+        self._backend.open()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._status_mgr.__exit__(exc_type, exc_val, exc_tb)
+        self._backend.close()
+        self._commit_pending()
+        self._status.close()
+
+    @property
+    def path(self):
+        return self._d
 
     def has_item(self, name):
-        return name in self._status
+        return name in self._pending or name in self._status
 
     def is_correct(self, name):
-        return self.has_item(name) and isinstance(self._status[name], int)
+        return name in self._pending or isinstance(self._status.get(name), int)
 
     def filter_items(self, names):
         for name in names:
-            if name not in self._status:
+            if not self.has_item(name):
                 yield name
 
-    def items(self):
-        return self._status.keys()
+    def items(self, prefix=None):
+        self.flush()
+        return self._status.keys(prefix)
 
-    def _format_path(self, name):
-        return f'{self._d}/{name}.json'
-
-    def clear_errors(self):
-        for name, v in tuple(self._status.items()):
+    def clear_errors(self, check_records=True):
+        # Drops err marks and, with `check_records`, statuses whose record is
+        # gone, which costs a backend lookup per stored record
+        self.flush()
+        for name in [
+            name for name, v in self._status.items()
             if (
                     isinstance(v, str) and v.startswith('err')
-            ) or not isfile(self._format_path(name)):
-                del self._status[name]
+            ) or (check_records and not self._backend.exists(name))
+        ]:
+            del self._status[name]
 
     def store_item(self, name, json_data):
-        with open(self._format_path(name), 'w') as f:
-            json.dump(json_data, f)
-        self._status[name] = int(
+        self.store_raw(name, json.dumps(json_data).encode())
+
+    def store_raw(self, name, data: bytes):
+        # Stores an already serialized JSON record without a decode/encode round trip
+        t = monotonic()
+        data = self._codec.encode(data)
+        self._backend.write(name, data)
+        self._stored(name, int(
             datetime.utcnow().strftime('%s')
-        )
+        ))
+        METRICS.observe('storage.write_latency', monotonic() - t)
+        METRICS.inc('storage.writes')
+        METRICS.inc('storage.bytes', len(data))
 
     def read_item(self, name):
-        with open(self._format_path(name), 'r') as f:
-            return json.load(f)
+        t = monotonic()
+        data = json.loads(self.read_raw(name))
+        METRICS.observe('storage.read_latency', monotonic() - t)
+        return data
+
+    def read_raw(self, name) -> bytes:
+        return self._codec.decode(self._backend.read(name))
+
+    def _stored(self, name, ts):
+        # A buffered record's status is journaled once the backend has
+        # flushed it, so a crash can not leave a status without its record
+        self._pending[name] = ts
+        if not self._backend.buffered():
+            self._commit_pending()
+
+    def _commit_pending(self):
+        for name, ts in self._pending.items():
+            self._status[name] = ts
+        self._pending.clear()
 
     def del_item(self, name):
-        unlink(self._format_path(name))
+        self._backend.delete(name)
+
+    def flush(self):
+        self._backend.flush()
+        self._commit_pending()
+
+    def train_compression(self, sample=1000):
+        # Trains a shared dictionary on already stored records, records
+        # written before keep decoding with the dictionary they used
+        self.flush()
+        names = islice(
+            (name for name, v in self._status.items() if isinstance(v, int)), sample
+        )
+        self._codec.train(
+            self._codec.decode(self._backend.read(name)) for name in names
+        )
+
+    def merge(self, other: 'JSONStorage'):
+        # Copies the records and marks of `other` into this store. A stored
+        # record beats an err/notfound mark and the later of two records
+        # wins, so re-merging a shard or overlapping shards keeps the best copy.
+        self.flush()
+        other.flush()
+        merged = 0
+        for name, v in other._status.items():
+            current = self._status.get(name)
+            if isinstance(v, int):
+                if isinstance(current, int) and current >= v:
+                    continue
+                self._backend.write(name, self._codec.encode(other.read_raw(name)))
+                self._stored(name, v)
+            elif current is None and name not in self._pending:
+                self._status[name] = v
+            else:
+                continue
+            merged += 1
+        self.flush()
+        self._status.compact()
+        return merged
 
     def mark_err(self, name, msg=''):
+        self._pending.pop(name, None)
         self._status[name] = f'err {msg}'
 
     def mark_notfound(self, name, msg=''):
+        self._pending.pop(name, None)
         self._status[name] = f'notfound {msg}'
 
-    def archive(self):
-        archive_dir = 'archive'
+    def _archive_dir(self):
+        return path.join('archive', self._d.replace('/', '_'))
+
+    def _archive_volumes(self, archived, volume_bytes):
+        buf = BytesIO()
+        tar = tarfile.open(fileobj=buf, mode='w')
+        names = []
+        for name, ts in self._status.items():
+            if isinstance(ts, int) and archived.get(name, (None, -1))[1] < ts:
+                try:
+                    data = self._backend.read(name)
+                except FileNotFoundError:
+                    # deleted with del_item or lost by an old store
+                    continue
+                info = tarfile.TarInfo(f'{name}.json')
+                info.size = len(data)
+                info.mtime = ts
+                tar.addfile(info, BytesIO(data))
+                names.append((name, ts))
+                if buf.tell() >= volume_bytes:
+                    tar.close()
+                    yield buf.getvalue(), names
+                    buf = BytesIO()
+                    tar = tarfile.open(fileobj=buf, mode='w')
+                    names = []
+        tar.close()
+        if names:
+            yield buf.getvalue(), names
+
+    def archive(self, workers=None, volume_bytes=1 << 26, max_pending_bytes=1 << 28):
+        # Adds records stored since the last run as new size-bounded
+        # tar.xz volumes, compressed in parallel (lzma releases the GIL).
+        # At most `max_pending_bytes` of uncompressed volumes are queued for
+        # compression. manifest.json maps every record to its volume.
+        archive_dir = self._archive_dir()
         os.makedirs(archive_dir, exist_ok=True)
-        fname = path.join(archive_dir, self._d.replace('/', '_') + '.tar.xz')
-        with tarfile.open(fname, "w:xz") as tar:
-            tar.add(self._d)
+        manifest_fname = path.join(archive_dir, 'manifest.json')
+        try:
+            with open(manifest_fname, 'r') as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {'volumes': [], 'items': {}}
+        archived = manifest['items']
+        self.flush()
+
+        def write_volume(f, names):
+            fname = f'vol_{len(manifest["volumes"]):05d}.tar.xz'
+            with open(path.join(archive_dir, fname), 'wb') as vf:
+                vf.write(f.result())
+            for name, ts in names:
+                archived[name] = len(manifest['volumes']), ts
+            manifest['volumes'].append(fname)
+
+        workers = workers or os.cpu_count()
+        pending = deque()
+        pending_bytes = 0
+        with ThreadPoolExecutor(workers) as pool:
+            for data, names in self._archive_volumes(archived, volume_bytes):
+                while pending and (
+                        len(pending) >= workers or pending_bytes + len(data) > max_pending_bytes
+                ):
+                    size, f, done_names = pending.popleft()
+                    pending_bytes -= size
+                    write_volume(f, done_names)
+                pending.append((len(data), pool.submit(lzma.compress, data, preset=6), names))
+                pending_bytes += len(data)
+            while pending:
+                _, f, done_names = pending.popleft()
+                write_volume(f, done_names)
+
+        self._status.compact()
+        shutil.copyfile(f'{self._d}/status.bin', path.join(archive_dir, 'status.bin'))
+        with open(manifest_fname + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_fname + '.tmp', manifest_fname)
+        self._manifest = manifest
+
+    def read_archived_item(self, name):
+        if self._manifest is None:
+            with open(path.join(self._archive_dir(), 'manifest.json'), 'r') as f:
+                self._manifest = json.load(f)
+        volume, _ = self._manifest['items'][name]
+        fname = path.join(self._archive_dir(), self._manifest['volumes'][volume])
+        with tarfile.open(fname, 'r:xz') as tar:
+            data = tar.extractfile(f'{name}.json').read()
+        return json.loads(self._codec.decode(data))
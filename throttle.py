@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from time import monotonic
+from urllib.parse import urlsplit
+
+
+def is_failure(status, body, error_page=None):
+    if status is None or status == 429 or status >= 500:
+        return True
+    return error_page is not None and error_page(body)
+
+
+class AIMDController:
+    def __init__(
+            self, initial=4, min_limit=1, max_limit=256,
+            increase=1, decrease=.5, latency_tolerance=2.
+    ):
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self._lock = threading.Lock()
+        self._successes = 0
+        self._latency = None
+        self._base_latency = None
+        self._last_decrease = 0.
+
+    def record(self, latency, ok):
+        with self._lock:
+            if not ok:
+                self._successes = 0
+                # Failures from one window of requests count as a single signal
+                now = monotonic()
+                if now - self._last_decrease >= (self._latency or latency):
+                    self._last_decrease = now
+                    self.limit = max(self.min_limit, int(self.limit * self.decrease))
+                return
+
+            if self._latency is None:
+                self._latency = self._base_latency = latency
+            else:
+                self._latency = .9 * self._latency + .1 * latency
+            if self._latency < self._base_latency:
+                self._base_latency = self._latency
+            else:
+                self._base_latency += (self._latency - self._base_latency) * .001
+
+            self._successes += 1
+            if self._successes >= self.limit:
+                self._successes = 0
+                if self._latency <= self._base_latency * self.latency_tolerance:
+                    self.limit = min(self.max_limit, self.limit + self.increase)
+                else:
+                    self.limit = max(self.min_limit, self.limit - self.increase)
+
+
+class ThreadGate:
+    def __init__(self, controller: AIMDController):
+        self.controller = controller
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._inflight < self.controller.limit)
+            self._inflight += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+
+class AsyncGate:
+    def __init__(self, controller: AIMDController):
+        self.controller = controller
+        self._inflight = 0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._inflight < self.controller.limit)
+            self._inflight += 1
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        async with self._cond:
+            self._inflight -= 1
+            self._cond.notify_all()
+
+
+class HostThrottle:
+    def __init__(self, error_page=None, **controller_args):
+        self.error_page = error_page
+        self._controller_args = controller_args
+        self._lock = threading.Lock()
+        self._controllers = {}
+        self._gates = {}
+        self._async_gates = {}
+
+    def controller(self, url) -> AIMDController:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._controllers:
+                self._controllers[host] = AIMDController(**self._controller_args)
+            return self._controllers[host]
+
+    def gate(self, url) -> ThreadGate:
+        host = urlsplit(url).netloc
+        c = self.controller(url)
+        with self._lock:
+            if host not in self._gates:
+                self._gates[host] = ThreadGate(c)
+            return self._gates[host]
+
+    def async_gate(self, url) -> AsyncGate:
+        host = urlsplit(url).netloc
+        c = self.controller(url)
+        with self._lock:
+            if host not in self._async_gates:
+                self._async_gates[host] = AsyncGate(c)
+            return self._async_gates[host]
+
+    def record(self, url, latency, status, body):
+        failed = is_failure(status, body, self.error_page)
+        self.controller(url).record(latency, not failed)
+        return failed
+
+    def limits(self):
+        with self._lock:
+            return {
+                host: c.limit for host, c in self._controllers.items()
+            }
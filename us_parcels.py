@@ -1,45 +1,47 @@
-from json import JSONDecodeError
-
-from tqdm import tqdm
-
-from scrape import *
-from storage import *
-
-
-def process_us_parcels():
-    errors = 0
-    with JSONStorage('cumberland') as stor:
-        # stor.clear_errors()
-        with open('cumberland_47035970102_1.json', 'r') as f:
-            rr = json.load(f)
-        rr = tuple(
-            v.replace('http:', 'https:') for v in rr
-        )
-        total_len = len(rr)
-        mapp = {
-            url.split('/')[-1].split('.')[0] : url for url in rr
-        }
-        rr = tuple(stor.filter_items(mapp.keys()))
-        filtered_len = total_len - len(rr)
-        counter = tqdm(map_scrape_get(
-            '{}',
-            (mapp[v] for v in rr), threads=16
-        ), total=total_len)
-        counter.update(filtered_len)
-        for n, v in counter:
-            n = n.split('/')[-1].split('.')[0]
-            try:
-                v = json.loads(v)
-                if 'id' in v:
-                    stor.store_item(n, v)
-                    errors = 0
-                    continue
-            except JSONDecodeError:
-                print(v)
-            if isinstance(v, dict) and 'Not found' in v.get('message', ""):
-                stor.mark_notfound(n)
-            else:
-                print(n, v)
-            errors += 1
-            if errors > 4096:
-                break
+import json
+
+from pipeline import JobSpec, run_job
+
+
+def _is_record(body: bytes):
+    return body[:1] == b'{' and body.rstrip()[-1:] == b'}' and b'"id"' in body
+
+
+def _is_block_page(body: bytes):
+    return not body.lstrip().startswith(b'{')
+
+
+def _is_not_found(body: bytes):
+    try:
+        v = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(v, dict) and 'Not found' in v.get('message', "")
+
+
+def _parcel_key(url):
+    return url.split('/')[-1].split('.')[0]
+
+
+def _parcel_items():
+    with open('cumberland_47035970102_1.json', 'r') as f:
+        return [url.replace('http:', 'https:') for url in json.load(f)]
+
+
+US_PARCELS = JobSpec(
+    name='cumberland',
+    url_template='{}',
+    items=_parcel_items,
+    key=_parcel_key,
+    is_record=_is_record,
+    is_block_page=_is_block_page,
+    is_not_found=_is_not_found,
+    parses=('is_not_found',),
+    threads=128,
+    initial_limit=16,
+    max_errors=4096,
+)
+
+
+def process_us_parcels(parse_workers=None, shard=0, shards=1):
+    run_job(US_PARCELS, parse_workers, shard=shard, shards=shards)